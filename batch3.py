@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 """Karaoke for an explicit list of YouTube IDs (passed as args)."""
-import sys, os, re, subprocess
+import sys, os, re, shlex
 from pytubefix import YouTube
 
+import kgen
+
 IDS = sys.argv[1:] or ["GA-OkMm1AJA", "S7qTs3MIuPU", "F64yFFnZfkI"]
 OUT = "/workspace/workspace/kout"
+# extra kgen flags for every song, e.g. KGEN_ARGS="--locate-model tiny --model small"
+KGEN_ARGS = shlex.split(os.environ.get("KGEN_ARGS", ""))
 os.makedirs(OUT, exist_ok=True)
 os.makedirs("/tmp/yt", exist_ok=True)
 
@@ -27,9 +31,10 @@ for i, vid in enumerate(IDS, 1):
             st = yt.streams.filter(progressive=True, file_extension="mp4").order_by("resolution").last()
             st.download(output_path="/tmp/yt", filename=f"{vid}.mp4")
         out = f"{OUT}/{vid}.karaoke.mp4"
-        r = subprocess.run([sys.executable, "kgen.py", mp4, "--title", title, "--artist", author or "",
-                            "--out", out, "--ass", f"/tmp/{vid}.ass", "--workdir", f"/tmp/kw_{vid}"])
-        print(f"[{i}] exit={r.returncode} -> {out if r.returncode == 0 else 'FAILED'}", flush=True)
+        # in-process, so whisper models loaded for one song stay resident for the next
+        kgen.main([mp4, "--title", title, "--artist", author or "", "--out", out,
+                   "--ass", f"/tmp/{vid}.ass", "--workdir", f"/tmp/kw_{vid}"] + KGEN_ARGS)
+        print(f"[{i}] ok -> {out}", flush=True)
     except Exception as e:
         import traceback; traceback.print_exc()
         print(f"[{i}] FAILED: {e}", flush=True)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Compare kgen inference backends (speed + word timing) on reference songs.
+
+    python3 bench_backends.py /tmp/yt/5mEpibSsq98.mp4 /tmp/yt/kagoEGKHZvU.mp4 \
+        --model small --backends torch,int8,faster-whisper
+
+Each song is separated once (through the stem store) and its lyrics fetched
+once — from a sibling .lrc if present, else by searching the file name — then
+aligned by every backend. `torch` (fp32) is the reference: for the others the
+table reports the word-start error against it. Lines whose word count differs
+from the reference are counted as mismatched instead of compared.
+"""
+import argparse, os, sys, time
+
+import kgen
+
+def words_delta(ref, got):
+    """(abs word-start errors, mismatched line count) of `got` vs `ref`."""
+    errs, bad = [], 0
+    for a, b in zip(ref, got):
+        if len(a) != len(b):
+            bad += 1; continue
+        errs += [abs(x[1] - y[1]) for x, y in zip(a, b)]
+    return errs, bad
+
+def bench(media, backends, model, workdir):
+    title = os.path.splitext(os.path.basename(media))[0]
+    lrc = os.path.splitext(media)[0] + ".lrc"
+    audio, stem_dir = kgen.extract_vocals(media, os.path.join(workdir, title),
+                                          kgen.StemCache(kgen.STEM_CACHE_DIR, kgen.STEM_CACHE_GB))
+    env = kgen.Envelope.cached(audio, os.path.join(stem_dir, "envelope.npz"))
+    lines, synced = kgen.load_lyrics(title, lrc if os.path.exists(lrc) else None)
+    rows, ref = [], None
+    for backend in backends:
+        t0 = time.time()
+        m = kgen.get_model(model, backend)
+        t_load = time.time() - t0
+        t0 = time.time()
+        lang = kgen.detect_lang(m, audio)
+        t_lang = time.time() - t0
+        t0 = time.time()
+        aligned = kgen.align(m, audio, lines, synced, lang, env=env)
+        t_align = time.time() - t0
+        if ref is None:
+            ref = aligned
+        errs, bad = words_delta(ref, aligned)
+        errs.sort()
+        rows.append((backend, t_load, t_lang, t_align, lang,
+                     sum(errs) / len(errs) if errs else 0.0,
+                     errs[int(len(errs) * 0.9)] if errs else 0.0,
+                     sum(e <= 0.1 for e in errs) / len(errs) if errs else 1.0, bad))
+    return title, rows
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    ap.add_argument("media", nargs="+", help="reference songs (video or audio)")
+    ap.add_argument("--model", default="small")
+    ap.add_argument("--backends", default=",".join(kgen.BACKENDS),
+                    help="comma-separated; the first is the reference")
+    ap.add_argument("--workdir", default="/tmp/kbench")
+    args = ap.parse_args()
+    backends = [b for b in args.backends.split(",") if b]
+    for b in backends:
+        if b not in kgen.BACKENDS:
+            sys.exit(f"unknown backend {b!r} (choose from {', '.join(kgen.BACKENDS)})")
+
+    out = []
+    for media in args.media:
+        print(f"\n===== {media} =====", flush=True)
+        out.append(bench(media, backends, args.model, args.workdir))
+
+    print(f"\nmodel={args.model}  reference={backends[0]}  (times in s; err = |word start - reference|)")
+    print(f"{'song':24} {'backend':15} {'load':>6} {'lang':>6} {'align':>7} {'lang':>4} "
+          f"{'mean err':>9} {'p90 err':>8} {'≤100ms':>7} {'mismatch':>8}")
+    for title, rows in out:
+        for backend, t_load, t_lang, t_align, lang, mean, p90, ok, bad in rows:
+            print(f"{title[:24]:24} {backend:15} {t_load:6.1f} {t_lang:6.1f} {t_align:7.1f} {lang:>4} "
+                  f"{mean:9.3f} {p90:8.3f} {ok:7.0%} {bad:8d}")
+
+if __name__ == "__main__":
+    main()
@@ -101,6 +101,10 @@ function handle_msg(evt) {
         }
         text += ', 队列长度：' + msg.data.length + '首';
         document.getElementById('marquee').innerHTML = text;
+    } else if (msg.type === 'timing') {
+        load_timing(msg.data);
+    } else if (msg.type === 'pos') {
+        sync_pos(msg.data);
     } else if (msg.type === 'op') {
         console.log(msg.data);
         document.getElementById(msg.data).style.display = 'inherit';
@@ -108,4 +112,94 @@ function handle_msg(evt) {
             document.getElementById(msg.data).style.display = 'none';
         }, 1000);
     }
-}
\ No newline at end of file
+}
+
+// ---- word-timing overlay ----
+// For songs whose lyrics are not burned into the video, the server sends the
+// URL of kgen's word-timing document ("timing") and the playing frame's song
+// position about once a second ("pos"); the highlight is drawn here.
+var timing = null;       // word-timing document of the playing song
+var timing_url = null;
+var song_t0 = null;      // performance.now() / 1000 at song time 0
+var POS_LATENCY = 0.15;  // s the picture lags the server's send (jitter buffer + decode)
+var shown = {L: null, R: null};
+
+function load_timing(url) {
+    timing_url = url;
+    timing = null;
+    song_t0 = null;
+    if (!url) {
+        return;
+    }
+    fetch(url).then(function(r) {
+        return r.ok ? r.json() : null;
+    }).then(function(doc) {
+        if (url === timing_url) {
+            timing = (doc && !doc.burned) ? doc : null; // burned: already in the picture
+        }
+    }).catch(function() {});
+}
+
+function sync_pos(pos) {
+    var t0 = performance.now() / 1000 - pos - POS_LATENCY;
+    // follow small drifts smoothly, jump on seeks / song changes
+    song_t0 = (song_t0 === null || Math.abs(t0 - song_t0) > 0.25) ? t0 : song_t0 * 0.9 + t0 * 0.1;
+}
+
+function set_line(slot, line) {
+    if (shown[slot] === line) {
+        return;
+    }
+    shown[slot] = line;
+    var el = document.getElementById('ly-' + slot);
+    el.innerHTML = '';
+    if (!line) {
+        return;
+    }
+    line.words.forEach(function(w) {
+        var span = document.createElement('span');
+        span.className = 'ly-word';
+        span.textContent = w[0];
+        span.dataset.w = w[0];
+        el.appendChild(span);
+    });
+}
+
+function draw_timing() {
+    requestAnimationFrame(draw_timing);
+    var on = timing && song_t0 !== null;
+    document.getElementById('lyrics').style.display = on ? 'block' : 'none';
+    if (!on) {
+        return;
+    }
+    var t = performance.now() / 1000 - song_t0;
+    var cur = {L: null, R: null}, cd = '';
+    timing.lines.forEach(function(line) {
+        if (line.start <= t && t < line.end) {
+            cur[line.slot] = line;
+        }
+        if (line.countdown) {
+            var w0 = line.words[0][1];
+            for (var k = 0; k < 3; k++) {
+                var cs = Math.max(0, w0 - (3 - k)), ce = w0 - (2 - k);
+                if (ce - cs > 0.05 && cs <= t && t < ce) {
+                    cd = timing.countdown[k];
+                }
+            }
+        }
+    });
+    document.getElementById('ly-cd').textContent = cd;
+    document.getElementById('ly-note').textContent = timing.note || '';
+    ['L', 'R'].forEach(function(slot) {
+        set_line(slot, cur[slot]);
+        if (!cur[slot]) {
+            return;
+        }
+        var spans = document.getElementById('ly-' + slot).children;
+        cur[slot].words.forEach(function(w, i) {
+            var p = Math.min(1, Math.max(0, (t - w[1]) / Math.max(0.01, w[2] - w[1])));
+            spans[i].style.setProperty('--p', (p * 100) + '%');
+        });
+    });
+}
+requestAnimationFrame(draw_timing);
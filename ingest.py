@@ -0,0 +1,104 @@
+"""Upload ingestion for ``/submit_task``, kept off the event loop.
+
+The loop that receives uploads also paces the live stream's audio (20 ms) and
+video (33 ms) frames, so it must never wait on a disk write. ``ingest`` reads
+the multipart file field in ``CHUNK``-sized pieces and queues them to a writer.
+The writer runs each write, and the sha256 update for the same bytes, on a
+small thread pool. At most ``DEPTH`` chunks are waiting at once. When the disk
+falls behind, ``ingest`` stops reading, and TCP flow control slows the sender
+instead of the server buffering the upload in memory.
+
+A streamed upload arrives as several requests, one per chunk (see the
+``offset``/``final`` fields). Its running hash, byte count and time spent
+receiving are kept in ``uploads``, keyed by the file path, between requests.
+``finish`` reports the totals once the last chunk is in.
+"""
+import asyncio
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK = 1 << 20     # bytes read from the request per step
+DEPTH = 8           # chunks queued for the writer at most (bounds memory per upload)
+
+POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="ingest")
+
+uploads = {}        # path -> {"sha", "size", "secs"} of an upload still arriving
+
+
+def _write(f, chunk, sha):
+    f.write(chunk)
+    sha.update(chunk)   # hashlib drops the GIL for large buffers
+
+
+def _rehash(path):
+    # resume a streamed upload whose state was lost (server restart): hash what's on disk
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK), b''):
+            sha.update(block)
+    return sha
+
+
+async def ingest(field, path, offset=0):
+    """Stream the multipart `field` into `path`: a new file if `offset` is 0,
+    else appended (the caller has checked the file is `offset` bytes long).
+    Returns the number of bytes written."""
+    loop = asyncio.get_running_loop()
+    state = uploads.get(path)
+    if not offset or state is None or state["size"] != offset:
+        sha = await loop.run_in_executor(POOL, _rehash, path) if offset else hashlib.sha256()
+        state = uploads[path] = {"sha": sha, "size": offset, "secs": 0.0}
+
+    t0 = time.time()
+    f = await loop.run_in_executor(POOL, open, path, 'ab' if offset else 'wb')
+    queue = asyncio.Queue(DEPTH)
+    error = []
+
+    async def writer():
+        # keeps draining after a failed write, so the reader never blocks on a full queue
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                return
+            if not error:
+                try:
+                    await loop.run_in_executor(POOL, _write, f, chunk, state["sha"])
+                except Exception as e:
+                    error.append(e)
+
+    task = asyncio.ensure_future(writer())
+    written = 0
+    try:
+        while field is not None and not error:
+            chunk = await field.read_chunk(CHUNK)
+            if not chunk:
+                break
+            await queue.put(chunk)
+            written += len(chunk)
+        await queue.put(None)
+        await task
+    finally:
+        task.cancel()
+        await loop.run_in_executor(POOL, f.close)
+    if error:
+        uploads.pop(path, None)
+        raise error[0]
+    state["size"] += written
+    state["secs"] += time.time() - t0
+    return written
+
+
+def finish(path):
+    """Totals of a completed upload: (sha256 hex, bytes, seconds receiving)."""
+    state = uploads.pop(path, None)
+    if state is None:
+        return None, 0, 0.0
+    return state["sha"].hexdigest(), state["size"], state["secs"]
+
+
+def discard(path):
+    uploads.pop(path, None)
+    if os.path.exists(path):
+        os.remove(path)
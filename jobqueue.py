@@ -0,0 +1,307 @@
+"""YouTube render job queue behind ``/poll_task``, ``/heartbeat`` and ``/submit_task``.
+
+Jobs keep the old ``workset`` row shape — ``[stage, uuid, url, title, singer, caps]``,
+stage 0 pending, 1 dispatched, 2 preview uploaded, -1 failed, >1000 done — so
+the pages reading ``/yt_list`` are unchanged. What's new is the bookkeeping
+beside each row:
+
+  • Dispatch is by lease. A worker holds a job for ``LEASE`` seconds and renews
+    the lease with heartbeats (an upload renews it too). A lease that runs out
+    puts the job back to pending, until ``MAX_ATTEMPTS`` dispatches have been
+    made; then it is marked failed. Another worker polling no longer fails a
+    job that is still running.
+  • Polling workers wait on a condition that ``add`` (and every requeue)
+    notifies, so a new job is handed out at once, not on the next 2 s scan.
+  • Workers advertise their capacity when they poll: ``slots`` (jobs held at
+    once), ``cores``, ``mem`` (GB) and ``models`` (those it can load). A job
+    that names a model only goes to workers that list it. While several
+    eligible workers wait, the one with the most cores takes the job. A pending
+    job that none of the connected workers can take for ``UNPLACEABLE`` s is
+    marked failed instead of waiting forever.
+  • Rows, leases and attempt counts are saved to ``STATE_FILE`` on every change
+    (write aside + rename), so a restart keeps pending and in-flight jobs. A
+    worker that is still rendering can still renew its lease after a restart.
+    Done and failed jobs are dropped ``RETENTION`` s after they finished.
+  • A row may carry a 7th element, ``{"model", "guide_vol"}``: render
+    parameters the request asked for (None = the worker's default).
+
+``RenderRegistry`` remembers finished renders by YouTube video id and render
+parameters (captions, model, guide volume), so a repeat request can queue the
+song that is already on disk instead of rendering it again.
+"""
+import asyncio
+import json
+import os
+import re
+import time
+
+LEASE = 60              # s a dispatched job stays with its worker without a heartbeat
+MAX_ATTEMPTS = 3        # dispatches before a job is given up as failed
+WORKER_TTL = 300        # s after its last poll/heartbeat a worker is forgotten
+UNPLACEABLE = 600       # s a pending job may wait with no connected worker able to take it
+RETENTION = 7 * 86400   # s a done / failed job stays listed
+STATE_FILE = '.jobs.json'
+RENDERS_FILE = '.renders.json'
+
+_YT_ID = re.compile(r"(?:v=|/embed/|/v/|youtu\.be/|/shorts/)([A-Za-z0-9_-]{11})")   # as kworker._video_id
+
+
+def video_id(url):
+    m = _YT_ID.search(url or "")
+    return m.group(1) if m else None
+
+
+def _same(want, got):
+    # a parameter the request leaves unset matches whatever a render used;
+    # numbers compare by value (a guide volume of 0 is "0", "0.0" or 0)
+    if want is None or want == "":
+        return True
+    try:
+        return float(want) == float(got)
+    except (TypeError, ValueError):
+        return str(want) == str(got)
+
+
+class JobQueue:
+    def __init__(self, path=STATE_FILE):
+        self.path = path
+        self.tasks = []     # workset rows (see module docstring)
+        self.meta = {}      # uuid -> {"worker", "expires", "attempts", "model", "finished"}
+        self.workers = {}   # worker id -> {"caps", "seen", "waiting"}
+        self._cond = asyncio.Condition()
+        self._load()
+
+    # ---- persistence ----
+    def _load(self):
+        try:
+            state = json.load(open(self.path, 'r'))
+        except Exception:
+            return
+        self.tasks = state.get('tasks', [])
+        self.meta = state.get('meta', {})
+        for task in self.tasks:
+            m = self.meta.setdefault(task[1], {"attempts": 0})
+            if task[0] in (1, 2) and not m.get('worker'):
+                task[0] = 0
+            elif task[0] in (1, 2):
+                m['expires'] = time.time() + LEASE  # heartbeats aren't saved: give the holder a fresh lease
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'tasks': self.tasks, 'meta': self.meta}, f)
+        os.replace(tmp, self.path)
+
+    def _wake(self):
+        async def notify():
+            async with self._cond:
+                self._cond.notify_all()
+        asyncio.ensure_future(notify())
+
+    # ---- jobs ----
+    def find(self, task_uuid):
+        for task in self.tasks:
+            if task[1] == task_uuid:
+                return task
+        return None
+
+    def add(self, task_uuid, url, title, singer, caps=None, model=None, guide_vol=None):
+        task = [0, task_uuid, url, title, singer, caps, {"model": model, "guide_vol": guide_vol}]
+        self.tasks.append(task)
+        self.meta[task_uuid] = {"attempts": 0, "model": model}
+        self.save()
+        self._wake()
+        return task
+
+    def in_flight(self, url, caps=None, model=None, guide_vol=None):
+        """A pending or running job rendering the same video with the same
+        parameters, or None. An unset model / guide volume matches any."""
+        vid = video_id(url)
+        for task in self.tasks:
+            params = task[6] if len(task) > 6 and task[6] else {}
+            if (task[0] in (0, 1, 2) and vid and video_id(task[2]) == vid and task[5] == caps
+                    and _same(model, params.get("model")) and _same(guide_vol, params.get("guide_vol"))):
+                return task
+        return None
+
+    def _fits(self, task, caps):
+        model = self.meta[task[1]].get('model')
+        return not model or model in caps.get('models', [])
+
+    def _eligible(self, task, caps):
+        return task[0] == 0 and self._fits(task, caps)
+
+    def _held(self, worker):
+        return sum(1 for t in self.tasks if t[0] in (1, 2) and self.meta[t[1]].get('worker') == worker)
+
+    def _pick(self, worker):
+        caps = self.workers[worker]['caps']
+        if self._held(worker) >= caps.get('slots', 1):
+            return None
+        for task in self.tasks:
+            if not self._eligible(task, caps):
+                continue
+            # leave it to a bigger idle worker that's waiting for work too
+            if any(w != worker and info['waiting'] and self._eligible(task, info['caps'])
+                   and info['caps'].get('cores', 0) > caps.get('cores', 0)
+                   and self._held(w) < info['caps'].get('slots', 1)
+                   for w, info in self.workers.items()):
+                continue
+            return task
+        return None
+
+    async def take(self, worker, caps, timeout=30, alive=lambda: True):
+        """Wait up to `timeout` s for a job `worker` can run and lease it to
+        the worker. Returns the row, or None (timeout, or `alive()` went false)."""
+        self.workers[worker] = {"caps": caps, "seen": time.time(), "waiting": True}
+        deadline = time.time() + timeout
+        try:
+            async with self._cond:
+                while time.time() < deadline and alive():
+                    task = self._pick(worker)
+                    if task:
+                        m = self.meta[task[1]]
+                        m.update(worker=worker, expires=time.time() + LEASE,
+                                 attempts=m.get('attempts', 0) + 1)
+                        task[0] = 1
+                        self.save()
+                        return task
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), min(2, max(0.01, deadline - time.time())))
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            if worker in self.workers:
+                self.workers[worker]['waiting'] = False
+                self.workers[worker]['seen'] = time.time()
+                self._wake()    # a job this worker passed on may be someone else's now
+        return None
+
+    def heartbeat(self, worker, task_uuid):
+        """Renew `worker`'s lease on the job; False if it no longer holds it."""
+        task = self.find(task_uuid)
+        m = self.meta.get(task_uuid, {})
+        if worker in self.workers:
+            self.workers[worker]['seen'] = time.time()
+        if not task or task[0] not in (1, 2) or m.get('worker') != worker:
+            return False
+        m['expires'] = time.time() + LEASE
+        return True
+
+    def touch(self, task_uuid):
+        # an upload for the job is arriving: whoever holds it is clearly alive
+        m = self.meta.get(task_uuid)
+        if m and m.get('worker'):
+            m['expires'] = time.time() + LEASE
+
+    def release(self, task_uuid, failed=False):
+        """Drop the job's lease: back to pending (or failed once out of
+        attempts) if `failed`, else it's done and the row keeps its stage."""
+        task = self.find(task_uuid)
+        m = self.meta.get(task_uuid)
+        if not task or not m:
+            return
+        m['worker'] = None
+        m.pop('expires', None)
+        if failed and task[0] in (1, 2):
+            task[0] = 0 if m.get('attempts', 0) < MAX_ATTEMPTS else -1
+            print("job", task_uuid, "requeued" if task[0] == 0 else "failed",
+                  f"(attempt {m.get('attempts', 0)}/{MAX_ATTEMPTS})")
+            self._wake()
+        if task[0] == -1 or task[0] > 1000:
+            m['finished'] = time.time()
+        self.save()
+
+    async def reap(self, every=5):
+        # requeue jobs whose lease ran out; forget workers that went away
+        while True:
+            await asyncio.sleep(every)
+            now = time.time()
+            for task in self.tasks:
+                m = self.meta.get(task[1], {})
+                if task[0] in (1, 2) and m.get('expires', now) < now:
+                    print("lease of", task[1], "held by", m.get('worker'), "expired")
+                    self.release(task[1], failed=True)
+            for w in [w for w, info in self.workers.items()
+                      if not info['waiting'] and now - info['seen'] > WORKER_TTL]:
+                del self.workers[w]
+            self._fail_unplaceable(now)
+            self._prune(now)
+
+    def _prune(self, now):
+        # forget done / failed jobs after RETENTION (rows from before the
+        # timestamp was kept count from now)
+        keep = []
+        for task in self.tasks:
+            m = self.meta.setdefault(task[1], {})
+            if task[0] == -1 or task[0] > 1000:
+                if now - m.setdefault('finished', now) > RETENTION:
+                    del self.meta[task[1]]
+                    continue
+            keep.append(task)
+        if len(keep) != len(self.tasks):
+            print("pruned", len(self.tasks) - len(keep), "finished jobs")
+            self.tasks[:] = keep        # main.workset is this same list
+            self.save()
+
+    def _fail_unplaceable(self, now):
+        # pending jobs no connected worker can run (e.g. a model none of them lists);
+        # with no workers connected at all, keep waiting for one
+        changed = False
+        for task in self.tasks:
+            if task[0] != 0:
+                continue
+            m = self.meta.get(task[1], {})
+            if not self.workers or any(self._fits(task, info['caps']) for info in self.workers.values()):
+                changed |= m.pop('unplaceable', None) is not None
+                continue
+            since = m.setdefault('unplaceable', now)
+            changed |= since == now
+            if now - since > UNPLACEABLE:
+                task[0] = -1
+                m['finished'] = now
+                print("job", task[1], "failed: no connected worker offers model", m.get('model'))
+                changed = True
+        if changed:
+            self.save()
+
+
+class RenderRegistry:
+    """Finished YouTube renders: video id + captions + model + guide volume ->
+    the song registered for it. Saved to `path` like the job state."""
+
+    def __init__(self, path=RENDERS_FILE):
+        self.path = path
+        self.renders = []   # {"video", "caps", "model", "guide_vol", "song", "title", "singer", "file"}
+        try:
+            self.renders = json.load(open(self.path, 'r'))
+        except Exception:
+            pass
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.renders, f)
+        os.replace(tmp, self.path)
+
+    def find(self, url, caps=None, model=None, guide_vol=None):
+        """The newest render of `url` with these parameters whose file is still
+        there, or None. An unset model / guide volume matches any."""
+        vid = video_id(url)
+        for r in reversed(self.renders):
+            if (vid and r["video"] == vid and r["caps"] == caps and _same(model, r["model"])
+                    and _same(guide_vol, r["guide_vol"]) and os.path.exists(r["file"])):
+                return r
+        return None
+
+    def add(self, url, caps, model, guide_vol, song, title, singer, file):
+        vid = video_id(url)
+        if not vid:
+            return
+        # a re-render with the same parameters supersedes the old entry
+        self.renders = [r for r in self.renders
+                        if not (r["video"] == vid and r["caps"] == caps and r["model"] == model
+                                and _same(guide_vol, r["guide_vol"]))]
+        self.renders.append({"video": vid, "caps": caps, "model": model, "guide_vol": guide_vol,
+                             "song": song, "title": title, "singer": singer, "file": file})
+        self.save()
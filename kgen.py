@@ -16,36 +16,524 @@ Pipeline:
 The ASS builder borrows the dual-line / lead-in / countdown ideas from the old
 karaoke_gen.py, but the alignment is rebuilt from scratch.
 """
-import argparse, os, re, subprocess, sys, tempfile
+import argparse, contextlib, json, os, re, shutil, subprocess, sys, tempfile, threading, time
 
 # ----------------------------- audio helpers ------------------------------
 
 def run(cmd):
     subprocess.run(cmd, check=True)
 
-def to_wav16k(src, dst):
-    """Decode any media to 16 kHz mono PCM (what whisper wants)."""
-    run(["ffmpeg", "-y", "-i", src, "-vn", "-ac", "1", "-ar", "16000",
-         "-acodec", "pcm_s16le", "-loglevel", "error", dst])
-    return dst
+def load_audio(src, sr=16000):
+    """Decode any media to mono float32 at `sr` (16 kHz is what whisper wants)
+    through an ffmpeg pipe — the one decode every later stage shares."""
+    import numpy as np
+    p = subprocess.run(["ffmpeg", "-nostdin", "-i", src, "-vn", "-ac", "1", "-ar", str(sr),
+                        "-f", "f32le", "-loglevel", "error", "-"], capture_output=True, check=True)
+    return np.frombuffer(p.stdout, np.float32).copy()
+
+def write_wav(path, x, sr=16000):
+    """Write float samples ((n,) mono or (n, ch)) as s16 PCM wav."""
+    if os.path.lexists(path):
+        os.remove(path)                 # may be a hardlink into the stem cache
+    w = _wav_writer(path, 1 if x.ndim == 1 else x.shape[1], sr)
+    try:
+        _wav_write(w, x)
+    finally:
+        w.close()
 
-def extract_vocals(media, workdir):
-    """Separate vocals with Spleeter (2stems). Returns a 16k-mono vocals wav.
+def _wav_writer(path, channels, sr):
+    import wave
+    w = wave.open(path, "wb")
+    w.setnchannels(channels); w.setsampwidth(2); w.setframerate(sr)
+    return w
 
-    Skips separation if a vocals wav already exists in workdir.
+def _wav_write(w, x):
+    import numpy as np
+    w.writeframes((np.clip(x, -1.0, 1.0) * 32767).astype("<i2").tobytes())
+
+def extract_vocals(media, workdir, cache=None, chunked=False, window=30.0, keep=False,
+                   acc_stream=1, key=None):
+    """Separate vocals with Spleeter (2stems). Returns `(audio, stem_dir)`: the
+    vocal stem decoded to 16 kHz mono float32, and the directory whose stems it
+    came from (the stem-cache entry, else workdir) for per-song derived data.
+
+    Skips separation if a vocals wav already exists in workdir, or if `cache`
+    (a StemCache) already holds the stems for this exact audio. `chunked` runs
+    Spleeter in-process over `window`-second slices (see separate_chunked)
+    instead of as a whole-file subprocess. The 16 kHz stem is only written to
+    disk for the stem cache, and into workdir if `keep`. `key` is the media's
+    audio_hash if the caller already has it.
+
+    If `media` has a second audio stream (audio stream `acc_stream`, None to
+    never look) that fits as the mix's accompaniment, the vocals are derived by
+    subtracting it (see subtract_accompaniment) and Spleeter isn't run.
     """
     os.makedirs(workdir, exist_ok=True)
     vocals = os.path.join(workdir, "vocals.wav")
     out16 = os.path.join(workdir, "vocals16k.wav")
-    if not os.path.exists(vocals):
+    key = (key or cache.key(media)) if cache else None
+    if key and cache.fetch(key, workdir, STEM_FILES if keep else STEM_FILES[:2]):
+        print(f"[1/5] Stem cache hit {key[:12]} -> {workdir}  ({cache.summary()})")
+        return load_audio(os.path.join(cache.entry(key), "vocals16k.wav")), cache.entry(key)
+    fit = None
+    if not os.path.exists(vocals) and acc_stream is not None and audio_streams(media) > acc_stream:
+        fit = track_offset(media, acc_stream)
+        if fit is None:
+            print(f"      audio stream {acc_stream} doesn't fit as the accompaniment — using Spleeter")
+    if fit:
+        print(f"[1/5] Subtracting accompaniment stream {acc_stream} from the mix -> {workdir}")
+        audio = write_separation(subtract_accompaniment(media, acc_stream, *fit), workdir)
+    elif not os.path.exists(vocals) and chunked:
+        print(f"[1/5] Separating vocals with Spleeter in {window:.0f}s windows -> {workdir}")
+        audio = write_separation(separate_chunked(media, window), workdir)
+    elif not os.path.exists(vocals):
         print(f"[1/5] Separating vocals with Spleeter -> {workdir}")
         # Run Spleeter as a subprocess so TensorFlow's memory is released before
         # the Torch/Whisper stage (both in-process can OOM a small box).
         run([sys.executable, "-m", "spleeter", "separate", "-p", "spleeter:2stems",
              "-o", workdir, "-f", "{instrument}.{codec}", media])
+        audio = load_audio(vocals)
     else:
         print(f"[1/5] Reusing existing vocals: {vocals}")
-    return to_wav16k(vocals, out16)
+        audio = load_audio(vocals)
+    if key or keep:
+        write_wav(out16, audio)
+        # what every later run gets from the store: the s16-quantized stem
+        audio = load_audio(out16)
+    if key:
+        cache.store(key, workdir)
+        print(f"      stem cache miss {key[:12]} — stored  ({cache.summary()})")
+        if not keep:
+            os.remove(out16)
+    return audio, (cache.entry(key) if key else workdir)
+
+# ------------------------- streaming separation ---------------------------
+# Whole-file Spleeter holds the full song's spectrogram in TensorFlow, so peak
+# memory grows with song length — which is why it runs as a subprocess. Fed
+# fixed-length windows instead, its footprint is bounded by the window size, so
+# it can share a process (and a small box) with Whisper.
+
+SEP_SR = 44100
+
+def _pcm_reader(media, sr=SEP_SR, channels=2, stream=0):
+    """Stream one of `media`'s audio tracks as float32 PCM through an ffmpeg pipe."""
+    return subprocess.Popen(["ffmpeg", "-i", media, "-map", f"0:a:{stream}", "-vn",
+                             "-ac", str(channels), "-ar", str(sr), "-f", "f32le",
+                             "-loglevel", "error", "-"], stdout=subprocess.PIPE)
+
+def _read_frames(proc, n, channels=2):
+    """Up to `n` frames from a _pcm_reader pipe ((k, channels) float32, k < n at EOF)."""
+    import numpy as np
+    raw = proc.stdout.read(n * 4 * channels)
+    raw = raw[:len(raw) - len(raw) % (4 * channels)]
+    return np.frombuffer(raw, np.float32).reshape(-1, channels)
+
+class _To16k:
+    """Streaming 44.1 kHz → 16 kHz mono resampler. Each block is resampled with
+    `ctx` samples of context on both sides so block edges don't see the filter's
+    zero padding; the right context is held back and emitted with the next
+    block. Exact (vs one whole-signal resample_poly) as long as every block but
+    the last is a whole multiple of 441 samples."""
+
+    def __init__(self, ctx=441 * 20):
+        import numpy as np
+        self.ctx, self.hist, self.lctx = ctx, np.zeros(0, np.float32), 0
+
+    def push(self, mono, last=False):
+        import numpy as np
+        from scipy.signal import resample_poly
+        mono = np.concatenate([self.hist, mono])
+        y = resample_poly(mono, 160, 441).astype(np.float32)
+        done = len(mono) if last else max(self.lctx, len(mono) - self.ctx)
+        out = y[self.lctx * 160 // 441:done * 160 // 441]
+        self.hist = mono[done - min(done, self.ctx):]
+        self.lctx = len(self.hist) - (len(mono) - done)
+        return out
+
+def separate_chunked(media, window=30.0, overlap=2.0):
+    """Run Spleeter 2stems over overlapping `window`-second slices and yield
+    `(vocals, accompaniment, vocals16k)` blocks as soon as each is final.
+
+    Consecutive windows share `overlap` seconds, blended with a linear
+    crossfade so the seams are inaudible; the 44.1 kHz stems are (n, 2) float32,
+    `vocals16k` the mono 16 kHz resample Whisper consumes. Window and overlap are
+    whole multiples of 441 samples so the 441→160 resampler stays phase-exact
+    across blocks. Memory is O(window) regardless of song length."""
+    import numpy as np
+    from spleeter.separator import Separator
+    sr = SEP_SR
+    ov = int(round(overlap * 10)) * sr // 10
+    hop = int(round(window * 10)) * sr // 10 - ov
+    ramp = np.linspace(0.0, 1.0, ov, dtype=np.float32)[:, None]
+    to16 = _To16k()
+    sep = Separator("spleeter:2stems", multiprocess=False)
+    proc = _pcm_reader(media)
+    carry = np.zeros((0, 2), np.float32)                 # overlap audio fed to the next window
+    tail = None                                          # previous window's (vocals, acc) overlap
+    try:
+        while True:
+            new = _read_frames(proc, hop)
+            last = len(new) < hop
+            wav = np.concatenate([carry, new])
+            if not len(new) and tail is None:
+                break
+            if len(wav):
+                pred = sep.separate(wav)
+                voc, acc = pred["vocals"][:len(wav)], pred["accompaniment"][:len(wav)]
+            else:
+                voc = acc = np.zeros((0, 2), np.float32)
+            if tail is not None:                         # crossfade the shared overlap
+                n = min(len(tail[0]), len(voc))
+                voc[:n] = tail[0][:n] * (1 - ramp[:n]) + voc[:n] * ramp[:n]
+                acc[:n] = tail[1][:n] * (1 - ramp[:n]) + acc[:n] * ramp[:n]
+            keep = 0 if last else min(ov, len(wav))
+            out_v, out_a = voc[:len(voc) - keep], acc[:len(acc) - keep]
+            tail = (voc[len(voc) - keep:].copy(), acc[len(acc) - keep:].copy()) if keep else None
+            carry = wav[len(wav) - keep:] if keep else carry[:0]
+            yield out_v, out_a, to16.push(out_v.mean(axis=1), last)
+            if last:
+                break
+    finally:
+        proc.stdout.close()
+        proc.wait()
+        del sep
+        try:
+            import tensorflow as tf
+            tf.keras.backend.clear_session()             # hand the memory back before Whisper
+        except Exception:
+            pass
+
+def write_separation(blocks, workdir):
+    """Drain separate_chunked() into vocals.wav / accompaniment.wav (s16 PCM) in
+    `workdir`, one block at a time; returns the 16 kHz vocal stem as an array."""
+    import numpy as np
+    outs, v16 = [], []
+    for name in ("vocals.wav", "accompaniment.wav"):
+        path = os.path.join(workdir, name)
+        if os.path.lexists(path):
+            os.remove(path)                             # may be a hardlink into the stem cache
+        outs.append(_wav_writer(path, 2, SEP_SR))
+    try:
+        for voc, acc, v in blocks:
+            _wav_write(outs[0], voc)
+            _wav_write(outs[1], acc)
+            v16.append(v)
+    finally:
+        for w in outs:
+            w.close()
+    return np.concatenate(v16) if v16 else np.zeros(0, np.float32)
+
+# --------------------- accompaniment-track subtraction ---------------------
+# Much of the KTV catalog ships an accompaniment stream beside the original mix
+# (the second audio track MediaPlayer(path, audio=1) plays). Then the vocals are
+# simply mix − accompaniment: the two tracks are time-aligned by
+# cross-correlation and subtracted in the STFT domain (magnitudes only, so codec
+# phase differences between the two encodes don't matter), and Spleeter isn't
+# needed at all.
+
+def audio_streams(media):
+    """Number of audio streams in `media` (0 if ffprobe can't tell)."""
+    p = subprocess.run(["ffprobe", "-v", "error", "-select_streams", "a", "-show_entries",
+                        "stream=index", "-of", "csv=p=0", media], capture_output=True, text=True)
+    return len(p.stdout.split()) if p.returncode == 0 else 0
+
+def track_offset(media, acc_stream=1, seconds=60.0, max_lag=2.0, sr=SEP_SR):
+    """Fit the accompaniment stream to the mix over the first `seconds`:
+    returns (lag, gain) — mix[n] ≈ gain · acc[n − lag] — or None when the two
+    don't look like a song and its accompaniment (weak correlation, or
+    nothing — or nearly everything — left after subtracting)."""
+    import numpy as np
+    from scipy.signal import resample_poly
+    n = int(seconds * sr)
+    procs = [_pcm_reader(media, sr, 1, stream) for stream in (0, acc_stream)]
+    try:
+        mix, acc = (_read_frames(p, n, 1)[:, 0] for p in procs)
+    finally:
+        for p in procs:
+            p.kill(); p.wait()
+    n = min(len(mix), len(acc))
+    if n < sr:
+        return None
+    mix, acc = mix[:n].astype(np.float64), acc[:n].astype(np.float64)
+    # coarse lag on a 4× decimated copy (FFT cross-correlation), then refine
+    # sample-exact around it at the full rate
+    a, b = resample_poly(mix, 1, 4), resample_poly(acc, 1, 4)
+    size = 1 << int(np.ceil(np.log2(2 * len(a))))
+    xc = np.fft.irfft(np.fft.rfft(a, size) * np.conj(np.fft.rfft(b, size)), size)
+    k = int(max_lag * sr / 4)
+    lags = np.r_[0:k + 1, -k:0]
+    coarse = int(lags[np.argmax(xc[lags])]) * 4
+
+    def fit(lag):
+        x, y = (mix[lag:], acc[:n - lag]) if lag >= 0 else (mix[:n + lag], acc[-lag:])
+        return x, y, float(x @ y)
+    lag = max(range(coarse - 6, coarse + 7), key=lambda l: fit(l)[2])
+    x, y, xy = fit(lag)
+    corr = xy / (np.sqrt((x @ x) * (y @ y)) or 1.0)
+    gain = xy / (y @ y or 1.0)
+    resid = float(((x - gain * y) ** 2).sum() / (x @ x or 1.0))
+    print(f"      accompaniment track: lag {lag / sr * 1000:+.1f} ms, gain {gain:.2f}, "
+          f"corr {corr:.2f}, vocal residual {resid:.0%}")
+    if corr < 0.5 or not 0.005 < resid < 0.7:
+        return None
+    return lag, gain
+
+def subtract_accompaniment(media, acc_stream, lag, gain, block=30.0, n_fft=1764, hop=441,
+                           floor=0.02):
+    """Yield `(vocals, accompaniment, vocals16k)` blocks like separate_chunked,
+    with vocals = STFT magnitude subtraction of the aligned accompaniment from
+    the mix (mix phase kept, each bin floored at `floor` of the mix).
+
+    Streamed in `block`-second chunks with a √Hann analysis/synthesis pair and
+    overlap-add carried across chunks, so it matches one whole-song STFT and
+    memory stays O(block). hop = 441 keeps every block a multiple of 441 for the
+    16 kHz resampler."""
+    import numpy as np
+    from numpy.lib.stride_tricks import sliding_window_view as view
+    sr, pad = SEP_SR, n_fft - hop
+    bs = int(round(block * 10)) * sr // 10
+    win = np.sqrt(0.5 - 0.5 * np.cos(2 * np.pi * np.arange(n_fft) / n_fft)).astype(np.float32)
+    norm = n_fft / (2 * hop)                             # Σ of the squared window over hops
+    mix_p, acc_p = _pcm_reader(media), _pcm_reader(media, stream=acc_stream)
+    zeros = lambda k: np.zeros((k, 2), np.float32)
+    apre = zeros(max(lag, 0))                            # acc starts `lag` later than the mix
+    if lag < 0:
+        _read_frames(acc_p, -lag)
+    xbuf, abuf, obuf = zeros(pad), zeros(pad), zeros(pad)
+    accq, skip, left = zeros(0), pad, None               # aligned acc FIFO, output warm-up
+    to16 = _To16k()
+    try:
+        while True:
+            m = _read_frames(mix_p, bs)
+            need = len(m) - min(len(apre), len(m))
+            a = np.concatenate([apre[:len(m)], _read_frames(acc_p, need) if need else zeros(0)])
+            apre = apre[len(m):]
+            a = np.concatenate([a, zeros(len(m) - len(a))])
+            accq = np.concatenate([accq, a])
+            last = len(m) < bs
+            if last:                                     # flush the final frames
+                left = len(accq)
+                m, a = np.concatenate([m, zeros(pad)]), np.concatenate([a, zeros(pad)])
+            x, y = np.concatenate([xbuf, m]), np.concatenate([abuf, a])
+            nf = (len(x) - n_fft) // hop + 1 if len(x) >= n_fft else 0
+            X = np.fft.rfft(view(x, n_fft, axis=0)[::hop][:nf] * win, axis=-1)
+            A = np.abs(np.fft.rfft(view(y, n_fft, axis=0)[::hop][:nf] * win, axis=-1))
+            mag = np.abs(X)
+            keep = np.maximum(mag - gain * A, floor * mag) / np.maximum(mag, 1e-9)
+            frames = np.fft.irfft(X * keep, n_fft, axis=-1).astype(np.float32) * (win / norm)
+            out = np.concatenate([obuf, zeros(nf * hop)])
+            for r in range(n_fft // hop):               # overlap-add, one hop-slice at a time
+                out[r * hop:r * hop + nf * hop] += (
+                    frames[:, :, r * hop:(r + 1) * hop].transpose(0, 2, 1).reshape(-1, 2))
+            voc, obuf = out[:nf * hop], out[nf * hop:]
+            xbuf, abuf = x[nf * hop:], y[nf * hop:]
+            cut = min(skip, len(voc))
+            voc, skip = voc[cut:], skip - cut
+            if last:
+                voc = voc[:left]
+            acc, accq = accq[:len(voc)], accq[len(voc):]
+            yield voc, acc, to16.push(voc.mean(axis=1), last)
+            if last:
+                break
+    finally:
+        for p in (mix_p, acc_p):
+            p.stdout.close(); p.kill(); p.wait()
+
+# ------------------------------ stem cache --------------------------------
+# Separation is the slowest stage and its output depends only on the audio, so
+# stems are kept in a store shared by every kgen run on the box (kworker jobs,
+# batch.py, manual reruns). Entries are keyed by a hash of the *decoded* audio,
+# so a re-download / remux of the same song still hits, and the store is
+# bounded in size by evicting the least-recently-used entries.
+
+STEM_FILES = ("vocals.wav", "accompaniment.wav", "vocals16k.wav")
+STEM_CACHE_DIR = os.environ.get("KGEN_STEM_CACHE") or os.path.join(
+    os.path.expanduser("~"), ".cache", "kgen", "stems")
+STEM_CACHE_GB = float(os.environ.get("KGEN_STEM_CACHE_GB", "20"))
+
+def audio_hash(media):
+    """sha256 of the first audio stream decoded to 44.1 kHz stereo s16 PCM."""
+    import hashlib
+    h = hashlib.sha256()
+    p = subprocess.Popen(["ffmpeg", "-i", media, "-map", "0:a:0", "-vn", "-ac", "2",
+                          "-ar", "44100", "-f", "s16le", "-loglevel", "error", "-"],
+                         stdout=subprocess.PIPE)
+    for chunk in iter(lambda: p.stdout.read(1 << 20), b""):
+        h.update(chunk)
+    if p.wait() != 0:
+        raise subprocess.CalledProcessError(p.returncode, "ffmpeg")
+    return h.hexdigest()
+
+class StemCache:
+    """Content-addressed, size-bounded LRU store of Spleeter stems.
+
+    Layout: <root>/<key[:2]>/<key>/{vocals,accompaniment,vocals16k}.wav. An
+    entry's mtime is its last use; eviction removes the oldest entries until the
+    store fits `max_bytes`. Hit/miss counters persist in <root>/stats.json so the
+    log shows the store's lifetime hit rate, not just this run's single lookup.
+    Several kgen processes may share one root: entries are published with an
+    atomic rename and stats/eviction run under an flock."""
+
+    def __init__(self, root=STEM_CACHE_DIR, max_gb=STEM_CACHE_GB):
+        self.root = root
+        self.max_bytes = int(max_gb * 1e9)
+        os.makedirs(root, exist_ok=True)
+
+    def key(self, media):
+        return audio_hash(media)
+
+    def entry(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def fetch(self, key, workdir, files=STEM_FILES):
+        """Link a complete entry's stems (those named in `files`) into `workdir`;
+        True on a hit."""
+        d = self.entry(key)
+        if not all(os.path.exists(os.path.join(d, f)) for f in STEM_FILES):
+            self._count("misses")
+            return False
+        os.makedirs(workdir, exist_ok=True)
+        try:
+            for f in files:
+                _link(os.path.join(d, f), os.path.join(workdir, f))
+            os.utime(d)                                 # mark as recently used
+        except OSError:                                 # evicted under us
+            self._count("misses")
+            return False
+        self._count("hits")
+        return True
+
+    def store(self, key, workdir):
+        """Publish the stems in `workdir` as the entry for `key`, then evict."""
+        d = self.entry(key)
+        if os.path.isdir(d):
+            os.utime(d)
+            return
+        os.makedirs(os.path.dirname(d), exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=".tmp_", dir=os.path.dirname(d))
+        for f in STEM_FILES:
+            _link(os.path.join(workdir, f), os.path.join(tmp, f))
+        try:
+            os.rename(tmp, d)
+        except OSError:                                 # another run published it first
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        with self._lock():
+            entries, total = [], 0
+            for sub in os.listdir(self.root):
+                p = os.path.join(self.root, sub)
+                if len(sub) != 2 or not os.path.isdir(p):
+                    continue
+                for k in os.listdir(p):
+                    d = os.path.join(p, k)
+                    if k.startswith("."):
+                        continue
+                    size = sum(os.path.getsize(os.path.join(d, f)) for f in os.listdir(d))
+                    entries.append((os.path.getmtime(d), size, k, d))
+                    total += size
+            entries.sort()
+            for _, size, k, d in entries:
+                if total <= self.max_bytes:
+                    break
+                if k == keep:
+                    continue
+                shutil.rmtree(d, ignore_errors=True)
+                total -= size
+                print(f"      stem cache: evicted {k[:12]} ({size / 1e6:.0f} MB)")
+
+    def summary(self):
+        s = self._stats()
+        return f"{s.get('hits', 0)} hits / {s.get('misses', 0)} misses"
+
+    @contextlib.contextmanager
+    def _lock(self):
+        import fcntl
+        with open(os.path.join(self.root, ".lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _stats(self):
+        try:
+            with open(os.path.join(self.root, "stats.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _count(self, field):
+        with self._lock():
+            s = self._stats()
+            s[field] = s.get(field, 0) + 1
+            with open(os.path.join(self.root, "stats.json"), "w") as f:
+                json.dump(s, f)
+
+def _link(src, dst):
+    """Hardlink src→dst (copy across filesystems), replacing any existing dst —
+    never write *through* it, since cached stems are shared inodes."""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+# ------------------------- alignment result cache -------------------------
+# A lyric fix usually touches one or two lines, yet a rerun would realign them
+# all. Alignment results are persisted beside the stems, keyed by everything
+# that determines them — the stem audio, model, language, line text and the
+# padded slice — so a rerun only pays for lines whose key changed.
+
+class LineCache:
+    """Persisted alignment results: the stage-1 pass (keyed by the full text)
+    and each line's stage-2 words (keyed by its text + padded span), in one
+    JSON file. Spans are rounded to 10 ms so float noise doesn't miss. The
+    global pass is keyed by `locate_model` when a cascade uses one."""
+
+    def __init__(self, path, stem_id, model_name, locate_model=None):
+        self.path, self.stem_id, self.model = path, stem_id, model_name
+        self.locate = locate_model or model_name
+        self.dirty = False
+        try:
+            with open(path, encoding="utf-8") as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = {}
+
+    def key(self, kind, lang, text, lo=0.0, hi=0.0):
+        import hashlib
+        model = self.locate if kind == "global" else self.model
+        raw = json.dumps([self.stem_id, model, kind, lang, text, round(lo, 2), round(hi, 2)],
+                         ensure_ascii=False)
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Cached value with (word, start, end) triples restored to tuples."""
+        def restore(x):
+            if not isinstance(x, list):
+                return x
+            if x and not any(isinstance(y, list) for y in x):
+                return tuple(x)
+            return [restore(y) for y in x]
+        v = self.data.get(key)
+        return None if v is None else restore(v)
+
+    def put(self, key, value):
+        def plain(x):
+            if isinstance(x, (list, tuple)):
+                return [plain(y) for y in x]
+            return x if isinstance(x, str) or x is None else float(x)
+        self.data[key] = plain(value)
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+        self.dirty = False
 
 # ----------------------------- lyric helpers ------------------------------
 
@@ -182,8 +670,10 @@ def load_lyrics(title, lyrics_file, lang=None, artist=None):
 
     lines, synced = [], False
     for ln in raw.splitlines():
-        stamps = _LRC_TS.findall(ln)
-        text = _LRC_TS.sub("", ln).replace("\xa0", " ").strip()
+        # enhanced LRC: the line starts at its first word stamp if it has no line stamp
+        stamps = _LRC_TS.findall(ln) or _WORD_TS.findall(ln)
+        text = _WORD_TS.sub("", _LRC_TS.sub("", ln)).replace("\xa0", " ")
+        text = re.sub(r"\s+", " ", text).strip()
         if not text or _META.search(text) or _LYRIC_NOISE.search(text) or text.startswith("《"):
             continue
         if stamps:
@@ -199,26 +689,147 @@ def load_lyrics(title, lyrics_file, lang=None, artist=None):
     print(f"[2/5] {len(lines)} lyric lines ({'synced LRC' if synced else 'plain'})")
     return lines, synced
 
+# ------------------------- word-synced lyrics -----------------------------
+# Musixmatch "richsync" lyrics carry a <mm:ss.xx> stamp per word. When they
+# line up with this video's vocal stem they ARE the word timing, so the whole
+# Whisper stage (model load, language detection, alignment) can be skipped.
+
+_WORD_TS = re.compile(r"<(\d+):(\d+)(?:[.:](\d+))?>")
+RICHSYNC_SEARCH = 3.0        # ± seconds of offset searched against the envelope
+RICHSYNC_MIN_VOICED = 0.6    # fraction of sung frames that must land on voice
+
+def _ts(m, s, c):
+    return int(m) * 60 + int(s) + int((c or "0").ljust(2, "0")[:2]) / 100
+
+def parse_richsync(raw):
+    """Enhanced LRC (`[mm:ss.xx] <mm:ss.xx> word <mm:ss.xx> word …`) → a list
+    of lines, each a list of (word, start, end), or [] if `raw` has no word
+    stamps. A word ends at the next stamp (Musixmatch stamps the spaces too),
+    so a closing stamp after the last word is its end. Without one, the last
+    word runs to the next line, at most ~0.3 s per character, and is left to
+    _fit_trailing to snap onto the held note."""
+    lines = []
+    for ln in raw.splitlines():
+        parts = _WORD_TS.split(_LRC_TS.sub("", ln))
+        # parts = [lead, m, s, c, chunk, m, s, c, chunk, …]
+        stamps = [(_ts(*parts[i:i + 3]), parts[i + 3]) for i in range(1, len(parts) - 3, 4)]
+        ws, space = [], False
+        for k, (t, chunk) in enumerate(stamps):
+            c = chunk[1:-1] if len(chunk) >= 2 and chunk[0] == chunk[-1] == " " else chunk.strip()
+            if not c.strip():
+                space = True; continue
+            end = stamps[k + 1][0] if k + 1 < len(stamps) else None
+            ws.append([(" " if space and ws else "") + c.strip(), t, end])
+            space = False
+        # tokens may carry no spaces ("Composed", "by"): test the credit and
+        # noise patterns on the space-joined text too, or \bby\b never matches
+        texts = ("".join(w for w, _, _ in ws), " ".join(w.strip() for w, _, _ in ws))
+        if not ws or any(_META.search(t) or _LYRIC_NOISE.search(t) for t in texts):
+            continue
+        lines.append(ws)
+    for i, ws in enumerate(lines):
+        nxt = lines[i + 1][0][1] if i + 1 < len(lines) else None
+        w, a, end = ws[-1]
+        if end is not None:         # explicit closing stamp
+            continue
+        cap = a + max(0.3, _nchars(w) * 0.3)
+        ws[-1][2] = min(cap, nxt) if nxt is not None else cap
+    return [[(w, a, max(b, a)) for w, a, b in ws] for ws in lines]
+
+def load_richsync(title, lyrics_file, lang=None, artist=None):
+    """Word-timed lyrics from an enhanced-LRC file, else Musixmatch richsync
+    across the same query variants as load_lyrics; [] if none."""
+    if lyrics_file and os.path.exists(lyrics_file):
+        return parse_richsync(open(lyrics_file, encoding="utf-8").read())
+    if not title:
+        return []
+    try:
+        import syncedlyrics
+        for q in lyric_queries(title, artist):
+            hit = syncedlyrics.search(q, artist=artist, enhanced=True, synced_only=True,
+                                      providers=["Musixmatch"])
+            if hit and _WORD_TS.search(hit) and _script_ok(hit, lang):
+                words = parse_richsync(hit)
+                if words:
+                    print(f"[2/5] Word-synced lyrics found for query: {q!r}")
+                    return words
+    except Exception as e:
+        print(f"      richsync search failed: {e}")
+    return []
+
+def richsync_offset(lines, env, search=RICHSYNC_SEARCH):
+    """(offset, voiced) — the shift within ±`search` s that best lays the sung
+    words of `lines` over the voiced frames of `env`, and the fraction of sung
+    frames that are voiced at that shift."""
+    import numpy as np
+    n = len(env.db)
+    sung = np.zeros(n, np.float32)
+    for ws in lines:
+        for _, a, b in ws:
+            sung[env.frame(a):env.frame(b)] = 1
+    total = float(sung.sum())
+    if not total:
+        return 0.0, 0.0
+    voiced = env.voiced.astype(np.float32)
+    best, best_lag, k = -1.0, 0, int(search / env.HOP)
+    for lag in range(-k, k + 1):                 # words moved `lag` frames later
+        sc = float(voiced[lag:] @ sung[:n - lag]) if lag >= 0 else float(voiced[:lag] @ sung[-lag:])
+        if sc > best or (sc == best and abs(lag) < abs(best_lag)):
+            best, best_lag = sc, lag
+    return best_lag * env.HOP, best / total
+
+def richsync_words(lines, env):
+    """`lines` shifted onto this video's vocals, or None if they don't fit."""
+    off, frac = richsync_offset(lines, env)
+    if frac < RICHSYNC_MIN_VOICED:
+        print(f"[3/5] Word-synced lyrics don't match the vocals "
+              f"({frac:.0%} voiced at best offset {off:+.2f}s) — aligning with whisper")
+        return None
+    print(f"[3/5] Using word-synced lyrics as-is (offset {off:+.2f}s, {frac:.0%} voiced) — no whisper")
+    if abs(off) < env.HOP:
+        return lines
+    return [[(w, max(0.0, a + off), max(0.0, b + off)) for w, a, b in ws] for ws in lines]
+
 # ----------------------------- alignment ----------------------------------
 
 def _nchars(text):
     return max(1, len([c for c in text if not c.isspace()]))
 
-def detect_lang(model, audio16k):
-    """Detect the spoken/sung language from the vocal track."""
+def log_mel30(model, audio):
+    """Log-mel spectrogram of the first 30 s of `audio`, as detect_language wants."""
     import whisper
+    return whisper.log_mel_spectrogram(
+        whisper.pad_or_trim(audio), getattr(model.dims, "n_mels", 80)).to(model.device)
+
+def detect_lang(model, audio):
+    """Detect the spoken/sung language from the decoded 16 kHz vocal track."""
     try:
-        audio = whisper.load_audio(audio16k)
-        mel = whisper.log_mel_spectrogram(
-            whisper.pad_or_trim(audio), getattr(model.dims, "n_mels", 80)).to(model.device)
-        _, probs = model.detect_language(mel)
+        if getattr(model, "backend", None) == "faster-whisper":
+            return model.detect(audio)
+        _, probs = model.detect_language(log_mel30(model, audio))
         return max(probs, key=probs.get)
     except Exception:
         return "en"
 
-def align(model, audio16k, lines, synced, lang, trusted=False):
+def cached_lang(model, audio, cache=None):
+    """detect_lang, remembered in the align cache (LineCache) under the stem, so
+    a fully cached re-render doesn't load the model just to detect it again."""
+    key = cache.key("lang", None, "") if cache else None
+    lang = cache.get(key) if cache else None
+    if lang is None:
+        lang = detect_lang(model, audio)
+        if cache:
+            cache.put(key, lang)
+    return lang
+
+def align(model, audio, lines, synced, lang, trusted=False, batch=False, pool=None,
+          env=None, cache=None, adaptive=False, locate=None):
     """Two-level alignment → a list of lines, each a list of (word, start, end).
 
+    `audio` is the decoded 16 kHz vocal stem (see load_audio), its language
+    detected here if `lang` is 'auto'; `env` its Envelope (computed here if
+    not given).
+
     Stage 1 (line level) — locate each line's [start, end] span in the audio:
       • `trusted` subtitle (timings pulled from the YouTube video itself): the
         subtitle timestamps ARE the spans, so no global pass is needed.
@@ -228,26 +839,47 @@ def align(model, audio16k, lines, synced, lang, trusted=False):
 
     Stage 2 (word level) — slice each sentence's own audio (±pad) and force-align
     just that line, so word timing is decided from a short *local* clip instead of
-    a single drift-prone whole-song pass.
+    a single drift-prone whole-song pass. `batch` packs many lines into each
+    model call (_local_align_batched); `pool` (an AlignPool) shards stage 2 and
+    the polish pass across worker processes. `cache` (a LineCache) reuses
+    stage-1 and per-line stage-2 results from earlier runs on the same stems.
+
+    `locate`, if given, is a cheaper model used only for the whole-song lyric
+    pass of stage 1 (a cascade: e.g. tiny finds the lines, `model` times the
+    words inside each short clip).
+
+    `adaptive` skips stage 2 for lines whose stage-1 words already look right
+    (the _repair confidence test, or _plausible for ASR segments) — only the
+    low-confidence and rebuilt lines are re-aligned locally.
     """
-    import whisper
-    audio = whisper.load_audio(audio16k)
     dur = len(audio) / 16000.0
+    env = env if env is not None else Envelope.compute(audio)
 
     if lang in (None, "auto"):
-        lang = detect_lang(model, audio16k)
+        lang = detect_lang(model, audio)
         print(f"[3/5] Detected language: {lang}")
 
     if not lines:
-        print("[3/5] Transcribing (no lyrics — weakest path)…")
-        res = model.transcribe(audio, language=lang, regroup=True, verbose=False)
-        spans = []
-        for seg in res.segments:
-            ws = [w for w in (seg.words or []) if w.word.strip()]
-            if ws:
-                spans.append((seg.text.strip(), ws[0].start, ws[-1].end))
+        segs = cache.get(cache.key("asr", lang, "")) if cache else None
+        if segs is None:
+            print("[3/5] Transcribing (no lyrics — weakest path)…")
+            res = model.transcribe(audio, language=lang, regroup=True, verbose=False)
+            segs = []
+            for seg in res.segments:
+                ws = [(w.word, w.start, w.end) for w in (seg.words or []) if w.word.strip()]
+                if ws:
+                    segs.append((seg.text.strip(), ws))
+            if cache:
+                cache.put(cache.key("asr", lang, ""), segs)
+        else:
+            print("[3/5] Reusing cached transcription")
+        spans = [(text, ws[0][1], ws[-1][2]) for text, ws in segs]
+        keep = None
+        if adaptive:
+            keep = [_sanitize(ws, s, e) if _plausible([s, e], _nchars(text), env) else None
+                    for (text, ws), (_, s, e) in zip(segs, spans)]
         print(f"      local word alignment of {len(spans)} lines…")
-        return _polish(_local_align(model, audio, spans, lang, dur), audio)
+        return _refine(model, audio, spans, lang, dur, env, batch, pool, cache, keep)
 
     texts = [t for _, t in lines]
     lrc_times = [t for t, _ in lines] if synced else None
@@ -256,9 +888,18 @@ def align(model, audio16k, lines, synced, lang, trusted=False):
         print(f"[3/5] Trusting subtitle timings; local word alignment of {len(texts)} lines…")
         spans = _spans_from_times(texts, lrc_times, dur)
     else:
-        print(f"[3/5] Global line alignment of {len(texts)} lines…")
-        res = model.align(audio, "\n".join(texts), language=lang, original_split=True)
-        repaired = _repair(_segments_to_lines(res.segments, texts), texts, lrc_times, dur)
+        gkey = cache.key("global", lang, "\n".join(texts)) if cache else None
+        line_words = cache.get(gkey) if cache else None
+        if line_words is None:
+            print(f"[3/5] Global line alignment of {len(texts)} lines…")
+            res = (locate or model).align(audio, "\n".join(texts), language=lang,
+                                          original_split=True)
+            line_words = _segments_to_lines(res.segments, texts)
+            if cache:
+                cache.put(gkey, line_words)
+        else:
+            print(f"[3/5] Reusing cached global alignment of {len(texts)} lines")
+        repaired, conf = _repair(line_words, texts, lrc_times, dur, env)
         spans, prev_e = [], 0.0
         for i, rw in enumerate(repaired):
             if rw:
@@ -267,7 +908,51 @@ def align(model, audio16k, lines, synced, lang, trusted=False):
                 s, e = prev_e, prev_e + max(0.5, _nchars(texts[i]) * 0.3)
             spans.append((texts[i], s, e)); prev_e = e
         print(f"      local word alignment of {len(texts)} lines…")
-    return _polish(_local_align(model, audio, spans, lang, dur), audio)
+        if adaptive:
+            keep = [rw if c else None for rw, c in zip(repaired, conf)]
+            return _refine(model, audio, spans, lang, dur, env, batch, pool, cache, keep)
+    return _refine(model, audio, spans, lang, dur, env, batch, pool, cache)
+
+def _refine(model, audio, spans, lang, dur, env, batch=False, pool=None, cache=None, keep=None):
+    """Stage 2 (per-line word alignment) + polish, in-process or on `pool`.
+    Lines whose (text, padded span) is in `cache` skip the model entirely, as
+    do lines with words already given in `keep` (adaptive mode, onset aligner)."""
+    out = list(keep) if keep else [None] * len(spans)
+    keys = [None] * len(spans)
+    if keep:
+        kept = sum(1 for ws in keep if ws is not None)
+        saved = f"{kept} fewer lines to pack" if batch else f"{kept} model calls saved"
+        print(f"      {kept}/{len(spans)} lines already word-timed ({saved})")
+    if cache:
+        for i, (text, s, e) in enumerate(spans):
+            if s is not None and out[i] is None:
+                keys[i] = cache.key("line", lang, text, *_padded(s, e, dur))
+                out[i] = cache.get(keys[i])
+    todo = [i for i in range(len(spans)) if out[i] is None]
+    if cache:
+        hits = sum(1 for i, k in enumerate(keys) if k and out[i] is not None)
+        print(f"      align cache: {hits}/{len(spans)} lines reused")
+
+    def fill(got):
+        for i, ws in zip(todo, got):
+            out[i] = ws
+            if keys[i]:
+                cache.put(keys[i], ws)
+        if cache:
+            cache.save()
+
+    sub = [spans[i] for i in todo]
+    if pool is None or len(sub) < 2:     # nothing worth sharding: stay in-process
+        fill(_local_align(model, audio, sub, lang, dur, batch=batch) if sub else [])
+        return _polish(out, env)
+    with pool.shared(audio) as ref:
+        fill(pool.local_align(ref, sub, lang, dur, batch) if sub else [])
+        return pool.polish(ref, out)
+
+def _padded(s, e, dur, pad=0.5):
+    """The (lo, hi) audio slice _local_align uses for a line spanning [s, e]."""
+    e = e if (e is not None and e > s) else s + 1.0
+    return max(0.0, s - pad), min(dur, e + pad)
 
 def _spans_from_times(texts, lrc_times, dur):
     """Line spans straight from synced (video-accurate) subtitle start times:
@@ -280,10 +965,15 @@ def _spans_from_times(texts, lrc_times, dur):
         out.append((texts[i], s, max(e, s + 0.3)))
     return out
 
-def _local_align(model, audio, spans, lang, dur, sr=16000, pad=0.5):
+def _local_align(model, audio, spans, lang, dur, sr=16000, pad=0.5, batch=False):
     """Force-align each sentence inside its own padded slice, mapping word times
     back to absolute. A short clip gives the aligner local context only, so a
-    mistake on one line can't drift the rest of the song."""
+    mistake on one line can't drift the rest of the song.
+
+    With `batch`, the padded slices are packed into ~30 s buffers and each pack
+    is aligned in one call (see _local_align_batched) — same result shape."""
+    if batch:
+        return _local_align_batched(model, audio, spans, lang, dur, sr, pad)
     out = []
     for text, s, e in spans:
         if s is None:
@@ -291,20 +981,81 @@ def _local_align(model, audio, spans, lang, dur, sr=16000, pad=0.5):
         e = e if (e is not None and e > s) else s + 1.0
         lo = max(0.0, s - pad)
         hi = min(dur, e + pad)
-        clip = audio[int(lo * sr):int(hi * sr)]
-        ws = []
-        if len(clip) > int(0.2 * sr):
-            try:
-                r = model.align(clip, text, language=lang, original_split=True)
-                ws = [(w.word, w.start + lo, w.end + lo)
-                      for seg in r.segments for w in (seg.words or []) if w.word.strip()]
-            except Exception:
-                ws = []
+        ws = _align_clip(model, audio[int(lo * sr):int(hi * sr)], text, lang, lo, sr)
         if not ws:                                      # alignment gave nothing → even split
             ws = _even_words(text, s, e)
         out.append(ws)
     return out
 
+def _align_clip(model, clip, text, lang, lo, sr=16000):
+    """Words of `text` force-aligned inside `clip` (which starts at `lo` s)."""
+    if len(clip) <= int(0.2 * sr):
+        return []
+    try:
+        r = model.align(clip, text, language=lang, original_split=True)
+        return [(w.word, w.start + lo, w.end + lo)
+                for seg in r.segments for w in (seg.words or []) if w.word.strip()]
+    except Exception:
+        return []
+
+def _local_align_batched(model, audio, spans, lang, dur, sr=16000, pad=0.5, limit=28.0, gap=1.0):
+    """_local_align with many lines per model call.
+
+    Whisper encodes a fixed 30 s window however short the clip, so one call per
+    3-second line wastes most of every encoder pass. Here consecutive padded
+    line slices are packed — separated by `gap` s of silence — into buffers of at
+    most `limit` s, the pack's lines are aligned in a single call with one text
+    line per slice (original_split keeps them as separate segments), and word
+    times are mapped back to each slice's absolute offset. A pack whose segments
+    don't come back 1:1 with its lines is re-done line by line, and so is a
+    line with a word that collapses to zero length on its slice's edge."""
+    import numpy as np
+    out = [None] * len(spans)
+    packs, cur, used = [], [], 0
+    for i, (text, s, e) in enumerate(spans):
+        if s is None:
+            out[i] = []; continue
+        e = e if (e is not None and e > s) else s + 1.0
+        a, b = int(max(0.0, s - pad) * sr), int(min(dur, e + pad) * sr)
+        if b - a <= int(0.2 * sr):
+            out[i] = _even_words(text, s, e); continue
+        need = (b - a) + (int(gap * sr) if cur else 0)
+        if cur and used + need > limit * sr:
+            packs.append(cur); cur, used = [], 0
+            need = b - a
+        cur.append((i, a, b)); used += need
+    if cur:
+        packs.append(cur)
+
+    silence = np.zeros(int(gap * sr), np.float32)
+    for pack in packs:
+        pieces, offs, pos = [], [], 0
+        for k, (i, a, b) in enumerate(pack):
+            if k:
+                pieces.append(silence); pos += len(silence)
+            pieces.append(audio[a:b]); offs.append(pos); pos += b - a
+        texts = [spans[i][0] for i, _, _ in pack]
+        try:
+            segs = model.align(np.concatenate(pieces), "\n".join(texts),
+                               language=lang, original_split=True).segments
+        except Exception:
+            segs = []
+        if len(segs) != len(pack):
+            segs = [None] * len(pack)
+        for (i, a, b), off, seg in zip(pack, offs, segs):
+            text, s, e = spans[i]
+            e = e if (e is not None and e > s) else s + 1.0
+            lo, hi = a / sr, b / sr
+            shift = lo - off / sr
+            ws = [(w.word, min(max(w.start + shift, lo), hi), min(max(w.end + shift, lo), hi))
+                  for w in ((seg.words or []) if seg is not None else []) if w.word.strip()]
+            # lost in the pack, or words squeezed onto the slice edges (placed in a
+            # neighbour's slice or the silence between) → align it alone
+            if not ws or any(we <= ws_ for _, ws_, we in ws):
+                ws = _align_clip(model, audio[a:b], text, lang, lo, sr) or _even_words(text, s, e)
+            out[i] = ws
+    return out
+
 def _segments_to_lines(segs, texts):
     """1:1 line→segment when original_split holds, else regroup by char count."""
     if len(segs) == len(texts):
@@ -321,23 +1072,30 @@ def _regroup_to_lines(words, texts):
         out.append(got)
     return out
 
-def _repair(line_words, texts, lrc_times, dur):
+def _plausible(span, nchars, env=None):
+    """Does a line aligned to `span` = [start, end] look right: non-trivial
+    length, a sane pace per character and (with `env`) sung, not silent?"""
+    if not span:
+        return False
+    dur_pc = (span[1] - span[0]) / nchars
+    if env is not None and env.voiced_frac(span[0], span[1]) < 0.2:
+        return False
+    return span[1] > span[0] + 0.15 and 0.05 <= dur_pc <= 1.6
+
+def _repair(line_words, texts, lrc_times, dur, env=None):
     """Trust well-aligned lines; rebuild degenerate ones from a global LRC offset
-    (if synced) or interpolation between confident neighbours."""
+    (if synced) or interpolation between confident neighbours. With `env`, a
+    line placed over a (mostly) silent stretch of the vocal stem is not
+    confident either, however plausible its pace.
+
+    Returns (lines, conf): conf[i] is True where line i kept the model's words."""
     n = len(texts)
     nchars = [_nchars(t) for t in texts]
     spans = []
     for ws in line_words:
         spans.append([min(w[1] for w in ws), max(w[2] for w in ws)] if ws else None)
 
-    def confident(i):
-        s = spans[i]
-        if not s:
-            return False
-        dur_pc = (s[1] - s[0]) / nchars[i]
-        return s[1] > s[0] + 0.15 and 0.05 <= dur_pc <= 1.6
-
-    conf = [confident(i) for i in range(n)]
+    conf = [_plausible(spans[i], nchars[i], env) for i in range(n)]
 
     # global LRC->audio offset from confident lines (median); handles a shifted intro
     offset = None
@@ -378,7 +1136,7 @@ def _repair(line_words, texts, lrc_times, dur):
         out.append(ws)
     if n_fixed:
         print(f"      repaired {n_fixed}/{n} lines the model could not align")
-    return out
+    return out, conf
 
 def _interp_starts(starts, nchars, dur):
     """Fill None starts by char-proportional interpolation/extrapolation; monotonic."""
@@ -433,6 +1191,202 @@ def _group_by_segments(res):
             out.append(_sanitize(ws, ws[0][1], ws[-1][2]))
     return out
 
+# ------------------------ vocal energy envelope ---------------------------
+# Frame energy of the vocal stem, computed once per song with strided NumPy
+# framing and cached beside the stems. Everything that asks "is the voice
+# sounding here?" — the held-note fit, _repair's confidence test, the ASS
+# countdown's instrumental-gap check — reads this instead of re-framing audio.
+
+class Envelope:
+    """Per-frame RMS (dB) of the vocal stem on a fixed 30 ms / 15 ms grid, plus
+    a song-level voiced mask with prefix sums, so `voiced_frac(a, b)` and
+    `level(t)` are O(1) and `window(a, b)` is a view."""
+
+    WIN, HOP = 0.03, 0.015
+
+    def __init__(self, db, duration):
+        import numpy as np
+        self.db = db
+        self.duration = duration
+        # relative floor from the loud end of the song; never above -45 dB
+        self.threshold = max(float(np.percentile(db, 99)) - 30, -45.0) if len(db) else -45.0
+        voiced = db > self.threshold
+        self._cum = np.concatenate([[0], np.cumsum(voiced, dtype=np.int64)])
+
+    @classmethod
+    def compute(cls, audio, sr=16000):
+        import numpy as np
+        win, hop = int(cls.WIN * sr), int(cls.HOP * sr)
+        x = np.asarray(audio, np.float32)
+        if len(x) < win:
+            return cls(np.zeros(0, np.float32), len(x) / sr)
+        frames = np.lib.stride_tricks.sliding_window_view(x, win)[::hop]
+        rms = np.sqrt(np.einsum("ij,ij->i", frames, frames) / win)
+        return cls((20 * np.log10(rms + 1e-7)).astype(np.float32), len(x) / sr)
+
+    @classmethod
+    def cached(cls, audio, path, sr=16000, key=None):
+        """Load the envelope saved at `path` (.npz) if it was computed from this
+        `audio` (`key`: its sha256 hex, hashed here if not given), or compute
+        and save it. A workdir reused with other vocals gets a fresh one."""
+        import numpy as np
+        if key is None:
+            import hashlib
+            key = hashlib.sha256(np.asarray(audio, np.float32).tobytes()).hexdigest()
+        try:
+            z = np.load(path)
+            if str(z["key"]) == key:
+                return cls(z["db"], float(z["duration"]))
+        except (OSError, KeyError, ValueError):
+            pass
+        env = cls.compute(audio, sr)
+        try:                                    # publish atomically: the entry is shared
+            tmp = f"{path}.{os.getpid()}.npz"
+            np.savez(tmp, db=env.db, duration=env.duration, key=key)
+            os.replace(tmp, path)
+        except OSError:
+            pass
+        return env
+
+    def frame(self, t):
+        return min(max(0, int(round(t / self.HOP))), len(self.db))
+
+    def time(self, fr):
+        """Centre time of frame `fr`."""
+        return fr * self.HOP + self.WIN / 2
+
+    def window(self, a, b):
+        """(first frame, dB view) for frames starting inside [a, b - WIN]."""
+        f0, f1 = self.frame(a), self.frame(max(a, b - self.WIN))
+        return f0, self.db[f0:f1]
+
+    @property
+    def voiced(self):
+        """Per-frame voiced mask (bool)."""
+        import numpy as np
+        return np.diff(self._cum) > 0
+
+    def level(self, t):
+        return float(self.db[min(self.frame(t), len(self.db) - 1)]) if len(self.db) else -140.0
+
+    def voiced_frac(self, a, b):
+        """Fraction of voiced frames in [a, b]."""
+        f0, f1 = self.frame(a), self.frame(b)
+        return (self._cum[f1] - self._cum[f0]) / (f1 - f0) if f1 > f0 else 0.0
+
+def _voiced_runs(voiced, merge):
+    """[(first, last)] voiced frame runs, bridging unvoiced dips of ≤ `merge` frames."""
+    import numpy as np
+    idx = np.flatnonzero(voiced)
+    if not len(idx):
+        return []
+    brk = np.flatnonzero(np.diff(idx) - 1 > merge)
+    return list(zip(idx[np.r_[0, brk + 1]].tolist(), idx[np.r_[brk, len(idx) - 1]].tolist()))
+
+# ------------------------- onset word alignment ---------------------------
+# With a trusted subtitle the line spans are already right; what's left is where
+# each unit (CJK char / Latin word) starts inside its line. Sung units mostly
+# begin on a spectral-flux onset of the vocal stem, so pick exactly one onset
+# per unit — the strongest chain near a syllable-weighted even split — instead
+# of running Whisper. Lines without enough clear onsets are left to Whisper.
+
+ONSET_MIN_CONF = 0.6       # share of a line's units that must land on clear onsets
+
+class Onsets:
+    """Spectral-flux onset strength of the vocal stem on a 10 ms grid (32 ms
+    Hann frames, log-compressed magnitude), normalised to the song's loud end,
+    plus the local-maximum candidates and which of them are clear peaks."""
+
+    WIN, HOP = 0.032, 0.01
+
+    def __init__(self, flux):
+        import numpy as np
+        from numpy.lib.stride_tricks import sliding_window_view as view
+        scale = float(np.percentile(flux[flux > 0], 90)) if np.any(flux > 0) else 1.0
+        self.flux = flux / (scale or 1.0)
+        pad = np.pad(self.flux, 10, mode="edge")
+        local_max = view(pad[7:-7], 7).max(axis=1)          # ±3 frames
+        local_mean = view(pad, 21).mean(axis=1)              # ±10 frames
+        self.peaks = np.flatnonzero((self.flux >= local_max) & (self.flux > 0))
+        self.clear = self.flux[self.peaks] > 1.5 * local_mean[self.peaks] + 0.1
+
+    @classmethod
+    def compute(cls, audio, sr=16000, block=4096):
+        import numpy as np
+        win, hop = int(cls.WIN * sr), int(cls.HOP * sr)
+        x = np.asarray(audio, np.float32)
+        if len(x) < win:
+            return cls(np.zeros(0, np.float32))
+        frames = np.lib.stride_tricks.sliding_window_view(x, win)[::hop]
+        hann = np.hanning(win).astype(np.float32)
+        flux, prev = np.zeros(len(frames), np.float32), None
+        for i in range(0, len(frames), block):            # bounded memory per block
+            mag = np.log1p(100 * np.abs(np.fft.rfft(frames[i:i + block] * hann, axis=1)))
+            d = np.diff(mag, axis=0, prepend=mag[:1] if prev is None else prev[None])
+            flux[i:i + block] = np.maximum(d, 0).sum(axis=1)
+            prev = mag[-1]
+        return cls(flux)
+
+    def time(self, fr):
+        """Onset time of frame `fr`: flux rises as soon as a new sound enters
+        the frame, i.e. when it reaches the frame's end."""
+        return fr * self.HOP + self.WIN
+
+    def between(self, a, b):
+        """(times, strengths, clear) of the onset candidates in [a, b]."""
+        t = self.time(self.peaks)
+        sel = (t >= a) & (t <= b)
+        return t[sel], self.flux[self.peaks[sel]], self.clear[sel]
+
+def onset_align(onsets, env, spans, lam=1.0, min_gap=0.06):
+    """Per line, (word, start, end) units placed on vocal onsets, or None where
+    the line's onsets are too weak to trust (fewer candidates than units, or
+    fewer than ONSET_MIN_CONF of the chosen ones clear).
+
+    Exactly one onset per unit is chosen by a DP over the line's candidates:
+    maximise onset strength (relative to the line's strongest) minus `lam` × the (line-relative) distance from the
+    unit's syllable-weighted expected start, with onsets ≥ `min_gap` s apart."""
+    import numpy as np
+    out = []
+    for text, s, e in spans:
+        if s is None:
+            out.append(None); continue
+        units = _units(text)
+        t, v, clear = onsets.between(max(0.0, s - 0.15), max(s, e - 0.1))
+        n, m = len(units), len(t)
+        if m < n:
+            out.append(None); continue
+        # the sung part of the span: up to the last voiced frame of the line
+        f0, db = env.window(s, e)
+        voiced = np.flatnonzero(db > env.threshold)
+        end = env.time(f0 + voiced[-1]) if len(voiced) else e
+        end = max(end, s + 0.3)
+        w = np.array([_syl_weight(u) for u in units], float)
+        expect = s + (end - s) * np.r_[0, np.cumsum(w)[:-1]] / w.sum()
+        v = v / v.max()
+        score = v[None, :] - lam * np.abs(t[None, :] - expect[:, None]) / (end - s)
+        best, back = score[0].copy(), np.zeros((n, m), int)
+        for k in range(1, n):
+            # best predecessor among candidates at least min_gap earlier
+            lim = np.searchsorted(t, t - min_gap, side="right")
+            run = np.maximum.accumulate(best)
+            arg = np.maximum.accumulate(np.where(best == run, np.arange(m), 0))
+            prev = np.where(lim > 0, run[np.maximum(lim - 1, 0)], -np.inf)
+            back[k] = arg[np.maximum(lim - 1, 0)]
+            best = score[k] + prev
+        if not np.isfinite(best.max()):
+            out.append(None); continue
+        pick = [int(np.argmax(best))]
+        for k in range(n - 1, 0, -1):
+            pick.append(back[k][pick[-1]])
+        pick = pick[::-1]
+        if np.mean(clear[pick]) < ONSET_MIN_CONF:
+            out.append(None); continue
+        starts = [float(t[j]) for j in pick]
+        ends = starts[1:] + [max(min(e, float(end) + 0.1), starts[-1] + 0.2)]
+        out.append([(u, a, b) for u, a, b in zip(units, starts, ends)])
+    return out
+
 # ----------------------- per-word timing polish ---------------------------
 # Whisper's word boundaries within a line can be jittery on hard/effected
 # vocals (near-zero "crammed" words, function words held >1s, big gaps). These
@@ -494,55 +1448,38 @@ def _min_dur(ws, lo=0.08):
         out.append((w, a, b)); floor = b
     return out
 
-def _fit_trailing(ws, audio, next_start, sr=16000):
+def _fit_trailing(ws, env, next_start):
     """Re-time the final word of a line onto the *held vocal note* itself.
 
     The aligner frequently mis-places a sustained final word: it labels the word
     late (leaving a long unsung gap before it) and/or lets its end run on toward
     the next line.  The audible truth is the dominant voiced run that follows the
-    previous word — the held note.  We measure the vocal energy there and snap the
-    final word onto that run, so the \\kf highlight covers the note exactly while
-    it is sung and cuts off sharply when the voice stops, rather than sweeping
-    late or bleeding into the next line.
+    previous word — the held note.  We measure the vocal energy there (from the
+    song's Envelope) and snap the final word onto that run, so the \\kf highlight
+    covers the note exactly while it is sung and cuts off sharply when the voice
+    stops, rather than sweeping late or bleeding into the next line.
 
     Ordinary short final words (no gap, not held, sane end) are left untouched."""
     if not ws:
         return ws
-    import numpy as np
     w, a, b = ws[-1]
     prev_end = ws[-2][2] if len(ws) >= 2 else a
     lo = prev_end
-    hi = min(prev_end + 10.0, len(audio) / sr)
+    hi = min(prev_end + 10.0, env.duration)
     if next_start:
         hi = min(hi, next_start - 0.05)              # never bleed into the next line
     if hi - lo < 0.4:
         return ws
-    seg = audio[int(lo * sr):int(hi * sr)]
-    win, hop = int(0.03 * sr), int(0.015 * sr)
-    nfr = max(1, (len(seg) - win) // hop)
-    db = np.array([20 * np.log10(np.sqrt(np.mean(seg[i*hop:i*hop+win] ** 2)) + 1e-7) for i in range(nfr)])
+    f0, db = env.window(lo, hi)
+    if not len(db):
+        return ws
     thr = max(db.max() - 22, -45)                    # relative silence floor
-    voiced = db > thr
     # longest contiguous voiced run (merging dips < ~0.25s) = the held note
-    merge = int(0.25 * sr / hop)
-    runs, i = [], 0
-    while i < nfr:
-        if not voiced[i]:
-            i += 1; continue
-        j, gap, k = i, 0, i
-        while k < nfr:
-            if voiced[k]:
-                j, gap = k, 0
-            else:
-                gap += 1
-                if gap > merge:
-                    break
-            k += 1
-        runs.append((i, j)); i = k + 1
+    runs = _voiced_runs(db > thr, int(0.25 / env.HOP))
     if not runs:
         return ws
     s_fr, e_fr = max(runs, key=lambda r: r[1] - r[0])
-    t_of = lambda fr: lo + (fr * hop + win / 2) / sr
+    t_of = lambda fr: env.time(f0 + fr)
     # A held note that ends sharply must be followed by silence. If the voiced
     # run reaches the window edge (no vocal-stop observed — e.g. a legato stem
     # with instrumental bleed, or an instrumental outro), its true end is unknown,
@@ -560,15 +1497,112 @@ def _fit_trailing(ws, audio, next_start, sr=16000):
         ws[-1] = (w, new_a, max(new_a + 0.3, new_b))
     return ws
 
-def _polish(lines, audio):
-    out = []
-    for i, ws in enumerate(lines):
-        ws = _smooth_line(ws)
-        ws = _min_dur(ws)
-        nxt = next((lines[j][0][1] for j in range(i + 1, len(lines)) if lines[j]), None)
-        ws = _fit_trailing(ws, audio, nxt)
-        out.append(ws)
-    return out
+def _polish(lines, env):
+    return [_polish_line(ws, env, nxt) for ws, nxt in zip(lines, _next_starts(lines))]
+
+def _polish_line(ws, env, nxt):
+    return _fit_trailing(_min_dur(_smooth_line(ws)), env, nxt)
+
+def _next_starts(lines):
+    """Start of the next non-empty line after each line (None for the last)."""
+    out, nxt = [], None
+    for ws in reversed(lines):
+        out.append(nxt)
+        if ws:
+            nxt = ws[0][1]
+    return out[::-1]
+
+# ----------------------- multi-process alignment --------------------------
+# Stage 2 aligns every line inside its own padded slice, so lines are
+# independent: shard them across worker processes, each holding its own model.
+# The decoded song is published once in shared memory and mapped by every
+# worker, instead of being pickled into each task.
+
+_WORKER = {}                                   # per-worker-process state
+
+def _pool_init(model_name, backend="torch"):
+    import torch
+    torch.set_num_threads(1)                   # N workers × 1 thread, not N × all cores
+    _WORKER["model"] = load_model(model_name, backend)
+
+def _pool_audio(ref):
+    """Map the shared audio buffer `ref` = (shm name, samples), once per song."""
+    import numpy as np
+    from multiprocessing import shared_memory
+    name, n = ref
+    if _WORKER.get("ref") != ref:
+        if _WORKER.get("shm"):
+            _WORKER["shm"].close()
+        shm = shared_memory.SharedMemory(name=name)
+        _WORKER.update(ref=ref, shm=shm, audio=np.ndarray((n,), np.float32, buffer=shm.buf),
+                       env=None)
+    return _WORKER["audio"]
+
+def _pool_align(task):
+    ref, spans, lang, dur, batch = task
+    return _local_align(_WORKER["model"], _pool_audio(ref), spans, lang, dur, batch=batch)
+
+def _pool_polish(task):
+    ref, lines, nexts = task
+    audio = _pool_audio(ref)
+    if _WORKER["env"] is None:                 # milliseconds; cheaper than shipping it
+        _WORKER["env"] = Envelope.compute(audio)
+    return [_polish_line(ws, _WORKER["env"], nxt) for ws, nxt in zip(lines, nexts)]
+
+class AlignPool:
+    """`jobs` worker processes, each with `model_name` (on `backend`) loaded
+    once for its whole lifetime (so one pool can serve many songs). The
+    processes start on first use: a song whose lines all come from the align
+    cache never spawns them."""
+
+    def __init__(self, model_name, jobs, backend="torch"):
+        self.jobs = jobs
+        self._args = (model_name, backend)
+        self._started = None
+
+    @property
+    def _pool(self):
+        if self._started is None:
+            import multiprocessing as mp
+            # spawn, not fork: a forked copy of an initialised torch runtime can deadlock
+            self._started = mp.get_context("spawn").Pool(self.jobs, initializer=_pool_init,
+                                                         initargs=self._args)
+        return self._started
+
+    @contextlib.contextmanager
+    def shared(self, audio):
+        """Publish `audio` in shared memory for the workers; yields its ref."""
+        import numpy as np
+        from multiprocessing import shared_memory
+        shm = shared_memory.SharedMemory(create=True, size=max(1, audio.nbytes))
+        try:
+            np.ndarray(audio.shape, np.float32, buffer=shm.buf)[:] = audio
+            yield (shm.name, len(audio))
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def _shards(self, items):
+        """Contiguous slices (order-preserving), a few per worker to balance load."""
+        k = max(1, -(-len(items) // (self.jobs * 4)))
+        return [(i, items[i:i + k]) for i in range(0, len(items), k)]
+
+    def local_align(self, ref, spans, lang, dur, batch=False):
+        shards = self._shards(spans)
+        print(f"      {len(spans)} lines in {len(shards)} shards on {self.jobs} workers")
+        parts = self._pool.map(_pool_align, [(ref, sp, lang, dur, batch) for _, sp in shards])
+        return [ws for part in parts for ws in part]
+
+    def polish(self, ref, lines):
+        nexts = _next_starts(lines)
+        parts = self._pool.map(_pool_polish, [(ref, ls, nexts[i:i + len(ls)])
+                                              for i, ls in self._shards(lines)])
+        return [ws for part in parts for ws in part]
+
+    def close(self):
+        if self._started is not None:
+            self._started.close()
+            self._started.join()
 
 # ------------------------------- ASS --------------------------------------
 
@@ -590,6 +1624,8 @@ Style: Hint,{font},{hint_size},&H64F0F0F0,&H64F0F0F0,&HB4000000,&HB4000000,0,1,0
 Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
 """
 
+COUNTDOWN = ("● ● ●", "● ●", "●")
+
 def _t(sec):
     sec = max(0.0, sec)
     h = int(sec // 3600); m = int(sec % 3600 // 60); s = int(sec % 60)
@@ -597,49 +1633,77 @@ def _t(sec):
     if cs == 100: s += 1; cs = 0
     return f"{h}:{m:02d}:{s:02d}.{cs:02d}"
 
-def build_ass(lines, ass_path, font="Microsoft YaHei", size=126, lead=3.0, note=None):
-    """Two stacked lines at the bottom: earlier line bottom-left (upper), next
-    line bottom-right (lower), alternating; per-word \\kf highlight + lead-in.
-    `note`, if given, is shown dimmed at the top for the whole song (used to flag
-    ASR-recognized lyrics when no official lyrics were found)."""
-    mv_bot = 45
-    mv_top = mv_bot + int(size * 1.5)          # upper line sits one line-height above
-    mv_cd = mv_top + int(size * 1.05)          # countdown sits just above the upper lyric line
-    hint_size = max(28, int(size * 0.42))
+def ass_layout(lines, lead=3.0, env=None):
+    """Where and when each lyric line shows — the layout build_ass renders.
+    Two stacked lines at the bottom: earlier line bottom-left (upper slot "L"),
+    next line bottom-right (lower slot "R"), alternating; each is shown from up
+    to `lead` s before its first word (once its slot is free) until its last
+    word ends. With the song's Envelope, a long gap only counts as a section
+    break if the voice is actually silent through it (not just a line the
+    aligner left unlabelled). Returns one dict per non-empty line:
+    slot, start, end, countdown (section start: 3→2→1 shown before it), words."""
     slot_free = {"L": 0.0, "R": 0.0}
     last_sung = 0.0
     slot = "L"
     first = True
+    out = []
+    for words in lines:
+        if not words:
+            continue
+        w0, wlast = words[0][1], words[-1][2]
+        gap = w0 - last_sung
+
+        # A real break before this line (song start, or a >4s instrumental gap)
+        # starts a new "section": show a 3→2→1 blue countdown on its own line
+        # above the lyrics, and put the line itself on the first (upper) line.
+        is_cd = (first or (gap > 4.0 and (env is None or
+                                          env.voiced_frac(last_sung + 0.5, w0 - 0.5) < 0.5))) \
+            and w0 >= 1.5
+        first = False
+        if is_cd:
+            slot = "L"
+        out.append(dict(slot=slot, start=max(slot_free[slot], w0 - lead), end=wlast,
+                        countdown=is_cd, words=words))
+        last_sung = wlast
+        slot_free[slot] = wlast
+        slot = "R" if slot == "L" else "L"
+    return out
+
+FONT = "Noto Sans CJK SC"    # --font default: renders CN/JP/KR + Latin
+
+def build_ass(lines, ass_path, font="Microsoft YaHei", size=126, lead=3.0, note=None, env=None):
+    """Lay out `lines` (ass_layout) and write them as ASS (write_ass). Returns
+    the layout (for write_timing)."""
+    layout = ass_layout(lines, lead, env)
+    write_ass(layout, ass_path, font, size, note)
+    return layout
+
+def write_ass(layout, ass_path, font="Microsoft YaHei", size=126, note=None):
+    """Render an ass_layout() as ASS: per-word \\kf highlight + lead-in, and a
+    3→2→1 countdown before each section. `note`, if given, is shown dimmed at
+    the top for the whole song (used to flag ASR-recognized lyrics when no
+    official lyrics were found)."""
+    mv_bot = 45
+    mv_top = mv_bot + int(size * 1.5)          # upper line sits one line-height above
+    mv_cd = mv_top + int(size * 1.05)          # countdown sits just above the upper lyric line
+    hint_size = max(28, int(size * 0.42))
     with open(ass_path, "w", encoding="utf-8") as f:
         f.write(ASS_HEADER.format(font=font, size=size, mv_top=mv_top, mv_bot=mv_bot, mv_cd=mv_cd, hint_size=hint_size))
         if note:
             f.write("Dialogue: 0,0:00:00.00,9:59:59.99,Hint,,0,0,0,,%s\n" % note)
-        for words in lines:
-            if not words:
-                continue
-            w0, wlast = words[0][1], words[-1][2]
-            gap = w0 - last_sung
-
-            # A real break before this line (song start, or a >4s instrumental gap)
-            # starts a new "section": show a 3→2→1 blue countdown on its own line
-            # above the lyrics, and put the line itself on the first (upper) line.
-            is_cd = (first or gap > 4.0) and w0 >= 1.5
-            first = False
-            if is_cd:
-                slot = "L"
-            style = slot
-            start = max(slot_free[style], w0 - lead)
-            lead_in = w0 - start
-
-            if is_cd:
+        for ev in layout:
+            words, start = ev["words"], ev["start"]
+            w0 = words[0][1]
+            if ev["countdown"]:
                 # one blue frame per second — three dots, then two, then one — ending
                 # exactly as the line begins.
-                for k, dots in enumerate(("● ● ●", "● ●", "●")):
+                for k, dots in enumerate(COUNTDOWN):
                     cs, ce = max(0.0, w0 - (3 - k)), w0 - (2 - k)
                     if ce - cs > 0.05:
                         f.write(f"Dialogue: 0,{_t(cs)},{_t(ce)},CD,,0,0,0,,{dots}\n")
 
             text = ""
+            lead_in = w0 - start
             if lead_in > 0.01:
                 text += "{\\k%d}" % int(lead_in * 100)   # invisible lead-in hold
 
@@ -652,12 +1716,39 @@ def build_ass(lines, ass_path, font="Microsoft YaHei", size=126, lead=3.0, note=
                 w = word.replace("\n", " ").replace("{", "(").replace("}", ")")
                 text += "{\\kf%d}%s" % (max(1, int((b - a) * 100)), w)
                 cur = b
-            last_sung = wlast
-            slot_free[style] = wlast
-            slot = "R" if slot == "L" else "L"
-            f.write(f"Dialogue: 0,{_t(start)},{_t(wlast)},{style},,0,0,0,,{text}\n")
+            f.write(f"Dialogue: 0,{_t(start)},{_t(ev['end'])},{ev['slot']},,0,0,0,,{text}\n")
     print(f"[4/5] Wrote {ass_path}")
 
+def write_timing(layout, path, note=None, burned=False):
+    """The ass_layout() as a compact word-timing document, for players that draw
+    the highlight themselves instead of showing a burned-in video:
+
+        {"version": 1, "burned": bool, "note": str | null, "countdown": ["● ● ●", "● ●", "●"],
+         "lines": [{"slot": "L" | "R", "start": s, "end": s, "countdown": bool,
+                    "words": [[text, start, end], ...]}, ...]}
+
+    Times are song seconds (ms precision); a countdown line shows COUNTDOWN[k]
+    from words[0].start - (3 - k) s, one second each, as build_ass does.
+    `burned` records whether the lyrics are also burned into the video (a
+    player must not draw them a second time)."""
+    r = lambda x: round(float(x), 3)
+    doc = {"version": 1, "burned": burned, "note": note or None, "countdown": list(COUNTDOWN),
+           "lines": [{"slot": ev["slot"], "start": r(max(0.0, ev["start"])), "end": r(ev["end"]),
+                      "countdown": ev["countdown"],
+                      "words": [[w.replace("\n", " "), r(a), r(b)] for w, a, b in ev["words"]]}
+                     for ev in layout]}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(doc, f, ensure_ascii=False, separators=(",", ":"))
+    print(f"      word timing -> {path}")
+
+def read_timing(path):
+    """A write_timing() document back as (layout, note, burned) — e.g. to
+    write_ass() it again for a player that overlays lyrics itself."""
+    with open(path, encoding="utf-8") as f:
+        doc = json.load(f)
+    layout = [dict(line, words=[tuple(w) for w in line["words"]]) for line in doc["lines"]]
+    return layout, doc.get("note"), doc.get("burned", False)
+
 # ------------------------------- burn -------------------------------------
 
 def _video_dims(path):
@@ -672,25 +1763,383 @@ def _video_dims(path):
     except Exception:
         return 0, 0
 
-def burn(video, ass, out):
-    print(f"[5/5] Burning subtitles -> {out}")
+# x264 settings for the burn. `threads` 0 = ffmpeg's auto; in a segmented burn
+# it becomes cores / jobs per segment process. `height` pins the canvas.
+ENCODE_PROFILES = {
+    "default": dict(preset="medium", crf=23, threads=0),     # = libx264's own defaults
+    "fast":    dict(preset="veryfast", crf=23, threads=0),
+    "quality": dict(preset="slow", crf=20, threads=0),
+    "preview": dict(preset="ultrafast", crf=30, threads=0, height=360),
+}
+
+def _burn_filter(video, ass, height=None):
     w, h = _video_dims(video)
     # Render onto at least a 640p 16:9 canvas so the (1080p-authored) ASS stays large
     # and crisp even when the source is tiny (libass renders text at the output size).
     # Bigger 16:9 sources are kept as-is, capped at 1080p; odd aspect ratios get padded.
-    th = min(1080, max(640, h or 640)); th -= th % 2
+    th = height or min(1080, max(640, h or 640)); th -= th % 2
     tw = (th * 16) // 9; tw -= tw % 2
     esc = ass.replace("\\", "\\\\").replace(":", "\\:").replace("'", "\\'")
-    vf = (f"scale={tw}:{th}:force_original_aspect_ratio=decrease,"
-          f"pad={tw}:{th}:(ow-iw)/2:(oh-ih)/2:color=black,setsar=1,ass='{esc}'")
     print(f"      canvas {tw}x{th} (source {w or '?'}x{h or '?'})")
-    run(["ffmpeg", "-y", "-i", video, "-vf", vf,
-         "-c:a", "copy", "-loglevel", "error", out])
+    return (f"scale={tw}:{th}:force_original_aspect_ratio=decrease,"
+            f"pad={tw}:{th}:(ow-iw)/2:(oh-ih)/2:color=black,setsar=1,ass='{esc}'")
+
+def _x264(profile, threads=None):
+    p = ENCODE_PROFILES[profile]
+    return ["-c:v", "libx264", "-preset", p["preset"], "-crf", str(p["crf"]),
+            "-threads", str(p["threads"] if threads is None else threads)]
+
+def _guide_mix(n, vol):
+    """filter_complex chain: accompaniment (input `n`) + vocal stem (input n+1)
+    at `vol` → [acc]."""
+    return (f"[{n}:a]volume=1.0[a0];[{n + 1}:a]volume={vol}[a1];"
+            f"[a0][a1]amix=inputs=2:duration=longest[acc]")
+
+def _audio_out(mix):
+    """Audio codec / metadata args: source audio copied as track 0, plus the
+    mixed accompaniment as AAC track 1 when `mix` is given."""
+    if not mix:
+        return ["-c:a", "copy"]
+    return ["-c:a:0", "copy", "-c:a:1", "aac",
+            "-metadata:s:a:0", "title=Vocal", "-metadata:s:a:1", "title=Accompaniment"]
+
+def _movflags(frag):
+    """+faststart (moov up front, written at the end by a second pass over the
+    file), or — `frag` — fragmented MP4: an empty moov, then one moof/mdat per
+    keyframe, appended in order and never rewritten, so the file can be read
+    (uploaded) while ffmpeg is still writing it."""
+    return ["-movflags", "+frag_keyframe+empty_moov+default_base_moof" if frag else "+faststart"]
+
+def burn(video, ass, out, profile="default", jobs=1, mix=None, frag=False):
+    """Burn `ass` onto `video` → `out` (audio copied). With `jobs` > 1 the video
+    is burned in that many keyframe-aligned segments in parallel (burn_segmented).
+
+    `mix` = (accompaniment wav, vocals wav, guide volume) adds the karaoke
+    track in the same ffmpeg run: track 0 stays the original audio, track 1 is
+    the accompaniment with the vocal stem mixed in at the guide volume. `frag`
+    writes fragmented MP4 (see _movflags)."""
+    print(f"[5/5] Burning subtitles -> {out}  (profile {profile}"
+          f"{', + accompaniment track' if mix else ''})")
+    vf = _burn_filter(video, ass, ENCODE_PROFILES[profile].get("height"))
+    if jobs > 1 and burn_segmented(video, vf, out, profile, jobs, mix, frag):
+        return
+    if mix:
+        acc, voc, vol = mix
+        cmd = (["ffmpeg", "-y", "-i", video, "-i", acc, "-i", voc, "-filter_complex",
+                f"[0:v]{vf}[v];{_guide_mix(1, vol)}", "-map", "[v]", "-map", "0:a:0", "-map", "[acc]"])
+    else:
+        cmd = ["ffmpeg", "-y", "-i", video, "-vf", vf]
+    run(cmd + _x264(profile) + _audio_out(mix) + _movflags(frag) + ["-loglevel", "error", out])
+
+def _keyframes(video):
+    """Keyframe timestamps (s) of the first video stream — only keyframes are decoded."""
+    out = subprocess.run(["ffprobe", "-v", "error", "-select_streams", "v:0", "-skip_frame", "nokey",
+                          "-show_entries", "frame=pts_time", "-of", "csv=p=0", video],
+                         capture_output=True, text=True).stdout
+    return sorted(float(t) for t in out.split() if t.replace(".", "", 1).isdigit())
+
+def _duration(video):
+    out = subprocess.run(["ffprobe", "-v", "error", "-show_entries", "format=duration",
+                          "-of", "csv=p=0", video], capture_output=True, text=True).stdout
+    try:
+        return float(out.strip())
+    except ValueError:
+        return 0.0
+
+def _segment_cuts(keys, dur, jobs):
+    """Up to `jobs` [start, end) spans cut at the keyframes nearest to an even split."""
+    cuts = [0.0]
+    for k in range(1, jobs):
+        t = min(keys, key=lambda x: abs(x - dur * k / jobs)) if keys else 0.0
+        if t > cuts[-1] + 1.0 and t < dur - 1.0:
+            cuts.append(t)
+    return list(zip(cuts, cuts[1:] + [dur]))
+
+def burn_segmented(video, vf, out, profile, jobs, mix=None, frag=False):
+    """Burn in parallel: one ffmpeg per keyframe-aligned segment, each with
+    cores / jobs encoder threads, then the concat demuxer joins the segments
+    (stream copy) and takes the audio from the source untouched — plus, with
+    `mix`, the accompaniment track mixed in that same final pass (see burn).
+
+    Each segment is input-seeked to its keyframe, so its frames restart at
+    t = 0; `setpts` shifts them back to song time before the `ass` filter, and
+    to 0 after it, so every segment renders the one ASS file exactly as the
+    single-pass burn would — also for lines straddling a cut. Returns False
+    (nothing done) if the video can't be split."""
+    dur = _duration(video)
+    spans = _segment_cuts(_keyframes(video), dur, jobs)
+    if len(spans) < 2:
+        print("      too short / too few keyframes to split — single pass")
+        return False
+    threads = ENCODE_PROFILES[profile]["threads"] or max(1, (os.cpu_count() or 1) // len(spans))
+    tmp = tempfile.mkdtemp(prefix="kburn_", dir=os.path.dirname(os.path.abspath(out)))
+    try:
+        procs, t0 = [], time.time()
+        for i, (a, b) in enumerate(spans):
+            seg = os.path.join(tmp, f"seg{i:03d}.mp4")
+            cmd = (["ffmpeg", "-y", "-ss", f"{a:.6f}", "-i", video, "-t", f"{b - a:.6f}", "-an",
+                    "-vf", f"setpts=PTS+{a:.6f}/TB,{vf},setpts=PTS-STARTPTS"]
+                   + _x264(profile, threads) + ["-loglevel", "error", seg])
+            procs.append((i, a, b, seg, subprocess.Popen(cmd)))
+        print(f"      {len(spans)} segments × {threads} threads")
+        done = {}
+        while len(done) < len(procs):
+            for i, a, b, seg, p in procs:
+                if i not in done and p.poll() is not None:
+                    if p.returncode:
+                        raise subprocess.CalledProcessError(p.returncode, "ffmpeg (segment %d)" % i)
+                    done[i] = time.time() - t0
+                    print(f"      segment {i} [{a:7.2f}s – {b:7.2f}s] burned in {done[i]:.1f}s")
+            time.sleep(0.2)
+        lst = os.path.join(tmp, "segments.txt")
+        with open(lst, "w") as f:
+            f.writelines(f"file '{seg}'\n" for _, _, _, seg, _ in procs)
+        cmd = ["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", lst, "-i", video]
+        if mix:
+            acc, voc, vol = mix
+            cmd += ["-i", acc, "-i", voc, "-filter_complex", _guide_mix(2, vol),
+                    "-map", "0:v:0", "-map", "1:a:0", "-map", "[acc]"]
+        else:
+            cmd += ["-map", "0:v:0", "-map", "1:a:0?"]
+        run(cmd + ["-c:v", "copy"] + _audio_out(mix) + _movflags(frag) + ["-loglevel", "error", out])
+        print(f"      segmented burn: {time.time() - t0:.1f}s wall, "
+              f"slowest segment {max(done.values()):.1f}s")
+        return True
+    finally:
+        for *_, p in procs:
+            if p.poll() is None:
+                p.kill()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+# ------------------------------- models -----------------------------------
+# Backends, all exposing the align / transcribe / detect_language calls kgen
+# makes, with the same res.segments[].words[] result shape:
+#   torch          — stable_whisper.load_model, fp32 PyTorch (the reference)
+#   int8           — the same model with its Linear layers dynamically
+#                    quantized to int8 (torch.ao, CPU only)
+#   faster-whisper — stable_whisper's CTranslate2 integration, compute_type int8
+
+BACKENDS = ("torch", "int8", "faster-whisper")
+# word timing against fp32 not yet measured on real songs (bench_backends.py):
+# reachable from bench_backends.py only, not from the kgen / kgen serve CLI
+EXPERIMENTAL_BACKENDS = ("int8", "faster-whisper")
+CLI_BACKENDS = tuple(b for b in BACKENDS if b not in EXPERIMENTAL_BACKENDS)
+
+_MODELS = {}
+_MODELS_LOCK = threading.Lock()
+
+def load_model(name, backend="torch"):
+    import stable_whisper
+    if backend == "faster-whisper":
+        return FasterWhisperModel(name)
+    model = stable_whisper.load_model(name, device="cpu" if backend == "int8" else None)
+    if backend == "int8":
+        import torch
+        # whisper's Linear subclass only adds a dtype cast (a no-op in fp32 on
+        # CPU); quantize_dynamic matches exact types, so demote it to nn.Linear.
+        for m in model.modules():
+            if isinstance(m, torch.nn.Linear):
+                m.__class__ = torch.nn.Linear
+        torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8,
+                                            inplace=True)
+    return model
+
+def model_id(name, backend="torch"):
+    """Name results are cached under: backends don't give identical timings."""
+    return name if backend == "torch" else f"{name}:{backend}"
+
+def get_model(name, backend="torch"):
+    """Load a model once per process (per backend) and keep it resident."""
+    with _MODELS_LOCK:
+        key = model_id(name, backend)
+        if key not in _MODELS:
+            if backend in EXPERIMENTAL_BACKENDS:
+                print(f"      ⚠ backend '{backend}' is experimental: its word timing vs fp32 "
+                      f"is unmeasured (run bench_backends.py first)")
+            t0 = time.time()
+            _MODELS[key] = load_model(name, backend)
+            print(f"      loaded whisper '{key}' in {time.time() - t0:.1f}s")
+        return _MODELS[key]
+
+_MODEL_CALLS = {}   # model_id -> lock held for each inference call on that model
+
+class LazyModel:
+    """get_model(name, backend), deferred to the first attribute access — a
+    render whose passes all hit the align cache never loads (or waits for) it.
+    Method calls hold a per-model lock: `kgen serve --max-jobs N` renders share
+    the resident model, whose inference isn't safe from several threads at
+    once, so their Whisper calls take turns (separation and burns still overlap)."""
+
+    def __init__(self, name, backend="torch"):
+        self.name, self.backend = name, backend
+
+    def __getattr__(self, attr):
+        value = getattr(get_model(self.name, self.backend), attr)
+        if not callable(value):
+            return value
+        with _MODELS_LOCK:
+            lock = _MODEL_CALLS.setdefault(model_id(self.name, self.backend), threading.RLock())
+
+        def call(*a, **kw):
+            with lock:
+                return value(*a, **kw)
+        return call
+
+class FasterWhisperModel:
+    """stable_whisper's faster-whisper model behind the whisper-model calls kgen
+    makes. Language detection goes through faster-whisper's own transcribe
+    (which detects before decoding), as there is no mel / dims to feed it."""
+
+    backend = "faster-whisper"
+
+    def __init__(self, name):
+        import stable_whisper
+        self.fw = stable_whisper.load_faster_whisper(name, device="cpu", compute_type="int8")
+
+    def align(self, audio, text, language=None, original_split=False):
+        return self.fw.align(audio, text, language=language, original_split=original_split)
+
+    def transcribe(self, audio, language=None, regroup=True, verbose=False):
+        return self.fw.transcribe_stable(audio, language=language, regroup=regroup,
+                                         verbose=verbose)
+
+    def detect(self, audio):
+        _, info = self.fw.transcribe(audio[:30 * 16000], beam_size=1, without_timestamps=True)
+        return info.language
+
+# ------------------------------- serve ------------------------------------
+# `kgen serve` keeps the Whisper model(s) hot in one long-lived process and runs
+# render jobs sent over a local Unix socket, so a worker host pays the model
+# load once instead of on every job. Protocol: one JSON line per connection,
+# {"argv": [<the usual kgen arguments>]}; the server streams the job's log back
+# as {"log": "..."} lines and ends with {"ok": true} or {"ok": false, "error": ...}.
+
+SERVE_SOCKET = os.environ.get("KGEN_SOCKET", "/tmp/kgen.sock")
+
+class _ThreadStdout:
+    """sys.stdout proxy: a job thread's prints go to its own sink (the client
+    socket), everything else to the real stdout."""
+
+    def __init__(self, real):
+        self.real = real
+        self.local = threading.local()
+
+    def write(self, text):
+        sink = getattr(self.local, "sink", None)
+        if sink is None:
+            return self.real.write(text)
+        sink(text)
+        return len(text)
+
+    def flush(self):
+        self.real.flush()
+
+def serve(argv):
+    import socketserver
+    ap = argparse.ArgumentParser(prog="kgen.py serve",
+                                 description="Resident kgen render server (models loaded once).")
+    ap.add_argument("--socket", default=SERVE_SOCKET, help="Unix socket path ($KGEN_SOCKET)")
+    ap.add_argument("--models", default="small",
+                    help="comma-separated models to preload, each optionally NAME:BACKEND "
+                         f"(backends: {', '.join(CLI_BACKENDS)})")
+    ap.add_argument("--max-jobs", type=int, default=1, help="renders allowed to run at once")
+    args = ap.parse_args(argv)
+
+    preload = []
+    for entry in filter(None, args.models.split(",")):
+        name, _, backend = entry.strip().partition(":")
+        if (backend or "torch") not in CLI_BACKENDS:
+            ap.error(f"backend {backend!r} of {entry.strip()!r} is not available "
+                     f"(choose from {', '.join(CLI_BACKENDS)})")
+        preload.append((name, backend or "torch"))
+    t0 = time.time()
+    for name, backend in preload:
+        get_model(name, backend)
+    print(f"[serve] models ready in {time.time() - t0:.1f}s: {', '.join(_MODELS) or '-'}")
+
+    out = sys.stdout = _ThreadStdout(sys.stdout)
+    slots = threading.BoundedSemaphore(args.max_jobs)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            gone = []
+
+            def send(msg):
+                # a client that went away mustn't abort the render: it still
+                # fills the stem / align caches and writes its output
+                if gone:
+                    return
+                try:
+                    self.wfile.write((json.dumps(msg, ensure_ascii=False) + "\n").encode("utf-8"))
+                    self.wfile.flush()
+                except OSError as e:
+                    gone.append(e)
+                    out.real.write(f"[serve] client disconnected ({e}); render continues\n")
+            try:
+                req = json.loads(self.rfile.readline().decode("utf-8"))
+                job = build_parser().parse_args(req["argv"])
+            except (ValueError, KeyError) as e:
+                send({"ok": False, "error": f"bad request: {e}"})
+                return
+            except SystemExit:                           # argparse already printed why
+                send({"ok": False, "error": "bad request: invalid kgen arguments"})
+                return
+            buf = []
+
+            def sink(text):                              # forward whole lines
+                buf.append(text)
+                if "\n" in text:
+                    send({"log": "".join(buf)}); buf.clear()
+
+            # a request without its own --workdir gets a scratch one, removed
+            # after the render (stems and align data live on in the stem store)
+            scratch = None if job.workdir else tempfile.mkdtemp(prefix="kgen_")
+            job.workdir = job.workdir or scratch
+            with slots:                                  # bounded concurrency; others queue here
+                out.local.sink = sink
+                t = time.time()
+                try:
+                    render(job)
+                    send({"ok": True, "seconds": round(time.time() - t, 1)})
+                except BaseException as e:
+                    send({"ok": False, "error": f"{type(e).__name__}: {e}"})
+                finally:
+                    out.local.sink = None
+                    if scratch:
+                        shutil.rmtree(scratch, ignore_errors=True)
+            out.real.write(f"[serve] job done in {time.time() - t:.1f}s: {job.input}\n")
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    with Server(args.socket, Handler) as srv:
+        print(f"[serve] listening on {args.socket} (max {args.max_jobs} concurrent jobs)")
+        srv.serve_forever()
+
+def submit(argv, sock=SERVE_SOCKET, log=print):
+    """Run a render on a `kgen serve` instance; raises RuntimeError on failure."""
+    import socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as c:
+        c.connect(sock)
+        c.sendall((json.dumps({"argv": list(argv)}) + "\n").encode("utf-8"))
+        for raw in c.makefile("rb"):
+            msg = json.loads(raw.decode("utf-8"))
+            if "log" in msg:
+                if msg["log"].strip():
+                    log(msg["log"].rstrip("\n"))
+            elif msg.get("ok"):
+                return msg
+            else:
+                raise RuntimeError(msg.get("error") or "render failed")
+    raise RuntimeError("kgen server closed the connection")
 
 # ------------------------------- main -------------------------------------
 
-def main():
-    ap = argparse.ArgumentParser(description="Generate a karaoke music video.")
+def build_parser():
+    ap = argparse.ArgumentParser(description="Generate a karaoke music video. "
+                                             "(`kgen.py serve --help` for the resident server.)")
     ap.add_argument("input", help="source video (or audio) file")
     ap.add_argument("--title", help="song title, used to fetch lyrics")
     ap.add_argument("--artist", help="artist/uploader, disambiguates same-title songs")
@@ -698,30 +2147,240 @@ def main():
     ap.add_argument("--subtitle", help="video-synced subtitle (.lrc) from the source — trust its line "
                                        "timings and only align words locally")
     ap.add_argument("--vocals", help="pre-extracted vocals wav (skip Spleeter)")
+    ap.add_argument("--separate", choices=("subprocess", "chunked"), default="subprocess",
+                    help="whole-file Spleeter subprocess, or in-process fixed-memory windows")
+    ap.add_argument("--acc-stream", type=int, default=1,
+                    help="audio stream carrying the accompaniment, if present; vocals are then "
+                         "mix minus accompaniment instead of Spleeter (-1: always Spleeter)")
+    ap.add_argument("--sep-window", type=float, default=30.0, help="chunked separation window (s)")
     ap.add_argument("--model", default="small", help="whisper model (tiny/base/small/medium)")
+    ap.add_argument("--backend", choices=CLI_BACKENDS, default="torch",
+                    help="inference backend (the int8 ones stay in bench_backends.py until "
+                         "their word timing is benchmarked)")
+    ap.add_argument("--locate-model", default=None,
+                    help="cheaper whisper model for the whole-song line pass (e.g. tiny); "
+                         "--model then only aligns the short per-line clips")
+    ap.add_argument("--batch-align", action="store_true",
+                    help="pack many lines into each word-alignment call (faster on CPU)")
+    ap.add_argument("--adaptive", action="store_true",
+                    help="re-align only the lines the global pass got wrong")
+    ap.add_argument("--jobs", type=int, default=1,
+                    help="shard per-line word alignment across N processes (each loads the model)")
+    ap.add_argument("--no-align-cache", action="store_true",
+                    help="realign every line instead of reusing cached per-line results")
+    ap.add_argument("--no-richsync", action="store_true",
+                    help="ignore word-synced (richsync) lyrics; always align with whisper")
+    ap.add_argument("--word-aligner", choices=("auto", "onset", "whisper"), default="auto",
+                    help="with --subtitle: place words on vocal onsets (auto: Whisper for unclear "
+                         "lines; onset: never load Whisper) or always use Whisper")
     ap.add_argument("--lang", default="auto", help="language code or 'auto' to detect")
     ap.add_argument("--ass", default="karaoke.ass")
     ap.add_argument("--out", help="output video (default: <input>.karaoke.mp4)")
-    ap.add_argument("--font", default="Noto Sans CJK SC", help="renders CN/JP/KR + Latin")
+    ap.add_argument("--font", default=FONT, help="renders CN/JP/KR + Latin")
     ap.add_argument("--size", type=int, default=126)   # 1.5x of the original 84
-    ap.add_argument("--no-burn", action="store_true", help="only produce the ASS")
+    ap.add_argument("--timing", default=None,
+                    help="word-timing JSON for live overlays (default: <ass>.timing.json)")
+    ap.add_argument("--no-burn", action="store_true", help="only produce the ASS (+ word timing)")
+    ap.add_argument("--separate-only", action="store_true",
+                    help="stop after separation (stems in --workdir and the stem store)")
+    ap.add_argument("--stem-key", default=None,
+                    help="the input's stem-store key from an earlier run (<workdir>/stem.key); skips hashing")
+    ap.add_argument("--burn-only", action="store_true",
+                    help="burn the existing --ass (from a --no-burn run with the same --workdir)")
+    ap.add_argument("--encode-profile", choices=sorted(ENCODE_PROFILES), default="default",
+                    help="x264 preset/crf/threads for the burn (--preview always uses 'preview')")
+    ap.add_argument("--burn-jobs", type=int, default=1,
+                    help="burn N keyframe-aligned segments in parallel, then concat (no re-encode)")
+    ap.add_argument("--guide-vol", type=float, default=None, metavar="VOL",
+                    help="add a 2nd audio track in the burn: accompaniment + vocal stem at VOL "
+                         "(0 = instrumental only); default: original audio only")
+    ap.add_argument("--fragmented", action="store_true",
+                    help="write fragmented MP4 (append-only, readable while encoding) instead of +faststart")
+    ap.add_argument("--preview", action="store_true",
+                    help="fast draft: no separation, tiny model / even split, 360p ultrafast burn")
     ap.add_argument("--workdir", default=None)
-    args = ap.parse_args()
-
+    ap.add_argument("--keep-intermediates", action="store_true",
+                    help="also write vocals16k.wav into the workdir")
+    ap.add_argument("--stem-cache", default=STEM_CACHE_DIR,
+                    help="shared content-addressed stem store ($KGEN_STEM_CACHE)")
+    ap.add_argument("--stem-cache-gb", type=float, default=STEM_CACHE_GB,
+                    help="evict least-recently-used stems above this size")
+    ap.add_argument("--no-stem-cache", action="store_true", help="don't read or fill the stem store")
+    return ap
+
+PREVIEW_MODEL = "tiny"
+ASR_NOTE = "⚠ 无官方歌词，以下歌词由人声识别生成  ·  No official lyrics — auto-recognized from vocals"
+
+def render(args):
+    """Run the whole pipeline for one parsed argument set."""
     workdir = args.workdir or tempfile.mkdtemp(prefix="kgen_")
     os.makedirs(workdir, exist_ok=True)
+    if args.burn_only:
+        return burn_only(args, workdir)
+    key = None
     if args.vocals:
         print(f"[1/5] Using provided vocals: {args.vocals}")
-        audio16k = to_wav16k(args.vocals, os.path.join(workdir, "vocals16k.wav"))
+        audio, stem_dir = load_audio(args.vocals), workdir
+        if args.keep_intermediates:
+            write_wav(os.path.join(workdir, "vocals16k.wav"), audio)
+    elif args.preview:
+        print("[1/5] Preview: timing against the full mix (no separation)")
+        audio, stem_dir = load_audio(args.input), workdir
     else:
-        audio16k = extract_vocals(args.input, workdir)
+        cache = None if args.no_stem_cache else StemCache(args.stem_cache, args.stem_cache_gb)
+        key = (args.stem_key or cache.key(args.input)) if cache else None
+        audio, stem_dir = extract_vocals(args.input, workdir, cache,
+                                         chunked=args.separate == "chunked",
+                                         window=args.sep_window, keep=args.keep_intermediates,
+                                         acc_stream=None if args.acc_stream < 0 else args.acc_stream,
+                                         key=key)
+        if key:     # for later runs on this workdir (--stem-key): hashing decodes the whole input
+            with open(os.path.join(workdir, "stem.key"), "w") as f:
+                f.write(key)
+    if args.separate_only:
+        print(f"Done (stems in {stem_dir}).")
+        return
+    # the align cache / envelope key: the stem-store key when there is one (stable
+    # across separation and every rerun), else the stem's own hash
+    stem_id = key
+    if not (stem_id or args.preview):
+        import hashlib
+        stem_id = hashlib.sha256(audio.tobytes()).hexdigest()
+    env = (Envelope.compute(audio) if args.preview
+           else Envelope.cached(audio, os.path.join(stem_dir, "envelope.npz"), key=stem_id))
+    line_cache = None
+    if not (args.no_align_cache or args.preview):
+        line_cache = LineCache(os.path.join(stem_dir, "align.json"), stem_id,
+                               model_id(args.model, args.backend),
+                               args.locate_model and model_id(args.locate_model, args.backend))
+
+    # Word-synced lyrics that fit the vocal stem need no aligner at all: go
+    # straight to the polish pass and never load whisper.
+    lang = args.lang if args.lang not in (None, "auto") else None
+    aligned, note = None, None
+    if args.preview:
+        aligned, note = preview_align(args, audio, env)
+    elif not args.subtitle and not args.no_richsync:
+        words = load_richsync(args.title, args.lyrics, lang, args.artist)
+        aligned = richsync_words(words, env) if words else None
+        if aligned:
+            aligned = _polish(aligned, env)
+    if aligned is None and args.subtitle and args.word_aligner != "whisper":
+        aligned = subtitle_align(args, audio, env, line_cache)
+    if aligned is None:
+        aligned, note = whisper_align(args, audio, env, line_cache)
+    layout = build_ass(aligned, args.ass, font=args.font, size=args.size, note=note, env=env)
+    write_timing(layout, args.timing or os.path.splitext(args.ass)[0] + ".timing.json", note,
+                 burned=not args.no_burn)
 
-    import stable_whisper
-    model = stable_whisper.load_model(args.model)
+    if not args.no_burn:
+        out = args.out or (os.path.splitext(args.input)[0] + ".karaoke.mp4")
+        burn(args.input, args.ass, out, "preview" if args.preview else args.encode_profile,
+             args.burn_jobs, None if args.preview else guide_mix(args, stem_dir, workdir),
+             args.fragmented)
+        print(f"Done -> {out}")
+    else:
+        print("Done (ASS only).")
+
+def burn_only(args, workdir):
+    """--burn-only: the burn step of render() on its own, for a caller that
+    staged the run (--separate-only, then --no-burn, then this). The stems are
+    in workdir (separation writes or links them there); the word timing is
+    re-marked as burned."""
+    out = args.out or (os.path.splitext(args.input)[0] + ".karaoke.mp4")
+    burn(args.input, args.ass, out, args.encode_profile, args.burn_jobs,
+         guide_mix(args, workdir, workdir), args.fragmented)
+    timing = args.timing or os.path.splitext(args.ass)[0] + ".timing.json"
+    if os.path.exists(timing):
+        layout, note, _ = read_timing(timing)
+        write_timing(layout, timing, note, burned=True)
+    print(f"Done -> {out}")
+
+def guide_mix(args, stem_dir, workdir):
+    """burn()'s `mix` for --guide-vol: the separation stems (stem dir first,
+    then workdir), or None — single audio track — if there are none."""
+    if args.guide_vol is None:
+        return None
+    for d in (stem_dir, workdir):
+        acc, voc = os.path.join(d, "accompaniment.wav"), os.path.join(d, "vocals.wav")
+        if os.path.exists(acc) and os.path.exists(voc):
+            return acc, voc, args.guide_vol
+    print("      no accompaniment/vocals stems — single audio track")
+    return None
+
+def preview_align(args, audio, env):
+    """Draft timing for --preview, good enough to check it's the right song:
+    synced lyrics / subtitles are split evenly inside their line times (no
+    model); plain lyrics get one whole-song pass of the tiny model, with
+    _repair's even split for lines it misses; no lyrics, a tiny transcription.
+    Never a per-line pass → (aligned lines, note)."""
+    dur = len(audio) / 16000.0
+    lang = args.lang if args.lang not in (None, "auto") else None
+    if args.subtitle and os.path.exists(args.subtitle):
+        lines, synced = load_lyrics(None, args.subtitle, lang)
+    else:
+        lines, synced = load_lyrics(args.title, args.lyrics, lang, args.artist)
+    texts = [t for _, t in lines]
+    if lines and synced:
+        print(f"[3/5] Preview: even split of {len(texts)} timed lines")
+        spans = _spans_from_times(texts, [t for t, _ in lines], dur)
+        return _polish([_even_words(t, s, min(e, s + _nchars(t) * 0.45 + 0.4))
+                        for t, s, e in spans], env), None
+    model = LazyModel(PREVIEW_MODEL, args.backend)
+    lang = lang or detect_lang(model, audio)
+    if lines:
+        print(f"[3/5] Preview: one {PREVIEW_MODEL} pass over {len(texts)} lines")
+        res = model.align(audio, "\n".join(texts), language=lang, original_split=True)
+        words, _ = _repair(_segments_to_lines(res.segments, texts), texts, None, dur, env)
+        return _polish(words, env), None
+    print(f"[3/5] Preview: {PREVIEW_MODEL} transcription (no lyrics)")
+    res = model.transcribe(audio, language=lang, regroup=True, verbose=False)
+    return _polish(_group_by_segments(res), env), ASR_NOTE
+
+def subtitle_align(args, audio, env, line_cache):
+    """Trusted-subtitle spans + onset-placed units; Whisper (loaded, and the
+    language detected, only then) re-aligns just the lines whose onsets are
+    unclear — or, with --word-aligner onset, they get an even split. None if
+    the subtitle has no usable timings."""
+    lines, synced = load_lyrics(None, args.subtitle) if os.path.exists(args.subtitle) else ([], False)
+    if not (lines and synced):
+        return None
+    dur = len(audio) / 16000.0
+    texts = [t for _, t in lines]
+    spans = _spans_from_times(texts, [t for t, _ in lines], dur)
+    words = onset_align(Onsets.compute(audio), env, spans)
+    weak = [i for i, ws in enumerate(words) if ws is None]
+    print(f"[3/5] Trusting subtitle timings; onset word alignment of {len(texts)} lines "
+          f"({len(weak)} unclear)")
+    if not weak:
+        return _polish(words, env)
+    if args.word_aligner == "onset":
+        for i in weak:
+            words[i] = _even_words(*spans[i])
+        return _polish(words, env)
+    model = LazyModel(args.model, args.backend)
+    lang = args.lang if args.lang not in (None, "auto") else cached_lang(model, audio, line_cache)
+    pool = AlignPool(args.model, args.jobs, args.backend) if args.jobs > 1 and len(weak) > 1 else None
+    try:
+        aligned = _refine(model, audio, spans, lang, dur, env, args.batch_align, pool,
+                          line_cache, keep=words)
+        if line_cache:
+            line_cache.save()
+    finally:
+        if pool:
+            pool.close()
+    return aligned
+
+def whisper_align(args, audio, env, line_cache):
+    """Load lyrics and word-align them with whisper → (aligned lines, note)."""
+    # workers spawn only once stage 2 has >1 line left after the align cache
+    pool = AlignPool(args.model, args.jobs, args.backend) if args.jobs > 1 else None
+    model = LazyModel(args.model, args.backend)
+    locate = LazyModel(args.locate_model, args.backend) if args.locate_model else None
 
     lang = args.lang
     if lang in (None, "auto"):
-        lang = detect_lang(model, audio16k)
+        lang = cached_lang(model, audio, line_cache)
         print(f"[2/5] Detected language: {lang}")
 
     # A video-synced subtitle (e.g. fetched from the YouTube captions) is trusted
@@ -737,16 +2396,23 @@ def main():
     else:
         lines, synced = load_lyrics(args.title, args.lyrics, lang, args.artist)
     # no usable official lyrics -> fall back to vocal recognition (ASR); flag it.
-    note = None if lines else "⚠ 无官方歌词，以下歌词由人声识别生成  ·  No official lyrics — auto-recognized from vocals"
-    aligned = align(model, audio16k, lines, synced, lang, trusted=trusted)
-    build_ass(aligned, args.ass, font=args.font, size=args.size, note=note)
-
-    if not args.no_burn:
-        out = args.out or (os.path.splitext(args.input)[0] + ".karaoke.mp4")
-        burn(args.input, args.ass, out)
-        print(f"Done -> {out}")
-    else:
-        print("Done (ASS only).")
+    note = None if lines else ASR_NOTE
+    try:
+        aligned = align(model, audio, lines, synced, lang, trusted=trusted,
+                        batch=args.batch_align, pool=pool, env=env, cache=line_cache,
+                        adaptive=args.adaptive, locate=locate)
+        if line_cache:
+            line_cache.save()
+    finally:
+        if pool:
+            pool.close()
+    return aligned, note
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["serve"]:
+        return serve(argv[1:])
+    render(build_parser().parse_args(argv))
 
 if __name__ == "__main__":
     main()
@@ -6,20 +6,38 @@ renders each one with ``kgen.py`` (Spleeter vocal extraction → lyric lookup &
 audio-driven alignment → ASS karaoke burn), and uploads the finished video back
 via ``/submit_task``.
 
-Protocol (unchanged from the original worker, so this is a drop-in replacement):
-  • GET  /poll_task   → ``[stage, uuid, url, title, singer, caps]`` (long-polls;
-                        204 when there's no work). The server marks the task
-                        ``stage = 1`` (dispatched) when it hands it out.
-  • POST /submit_task → multipart ``{uuid, file_content}`` on success.
-  • Errors are reported *implicitly*: a job we never submit stays ``stage = 1``,
-    and the server flips it to ``-1`` (→ "Failed" in the console) on the next
-    poll. So after every job — success or failure — we poll again promptly.
+Protocol (a superset of the original worker's):
+  • GET  /poll_task   → ``[stage, uuid, url, title, singer, caps, params]``
+                        (long-polls; ``params`` = ``{model, guide_vol}`` or absent;
+                        204 when there's no work). The query advertises this
+                        worker: ``worker`` id, ``slots``, ``cores``, ``mem`` (GB),
+                        ``models``. The server leases the task to us and marks
+                        it ``stage = 1`` (dispatched).
+  • POST /heartbeat   → ``{worker, uuid, state}`` every ``HEARTBEAT`` s while a
+                        job runs (``running`` renews the lease), and once with
+                        ``failed`` when it fails, so it is requeued right away.
+  • POST /submit_task → multipart ``{uuid, worker, kind, file_content}`` on success;
+                        ``kind`` is ``preview`` for the fast draft render (the
+                        server registers it right away) or ``final`` for the
+                        full render, which replaces the preview file in place.
+  • A job whose heartbeats stop (the worker died) is requeued when its lease
+    runs out, and marked ``-1`` ("Failed") after a few attempts. Several
+    workers can therefore poll one server.
 
 Like the original, the output carries **two audio tracks** so the player's
 原唱/伴奏 (vocal/accompaniment) toggle keeps working:
   track 0 = original audio (with vocals), track 1 = accompaniment + faint vocal
-guide. We build track 1 from the stems Spleeter already produced inside kgen's
-workdir, so there's no second separation pass.
+guide. kgen builds track 1 from its own separation stems (``--guide-vol``) in
+the same ffmpeg run that burns the subtitles, so the job's output is written
+once, already in its final form (``+faststart``).
+
+Jobs run through a pipeline: download → preview → separate → align → burn →
+upload, each stage a few threads with a bounded queue in front, so the next job
+downloads and separates while this one aligns and burns. The worker holds
+``slots`` jobs at once (the rendering ones plus a prefetched one) and says so
+when polling. Spleeter and Whisper tasks take their memory from one budget, so
+they only run side by side where they fit. Each stage's utilization is logged
+every minute, and each job's stage times when it finishes.
 
 Environment:
   KWORKER_SERVER    server base URL            (default https://kortc.lyric.today)
@@ -28,15 +46,37 @@ Environment:
   KWORKER_INSECURE  "1" to skip TLS verify     (self-signed dev servers)
   KWORKER_GUIDE_VOL accompaniment vocal guide  (default 0.08; 0 = full instrumental)
   KWORKER_MODEL     whisper model for kgen     (e.g. large-v3; default = kgen's own)
+  KWORKER_MODELS    models offered to jobs that name one (comma-separated;
+                    default: the whisper sizes that fit in memory)
+  KWORKER_STEM_CACHE shared kgen stem store   (default = kgen's $KGEN_STEM_CACHE)
+  KWORKER_KGEN_SOCKET Unix socket of a resident ``kgen.py serve`` (models stay
+                    loaded between jobs); unset or unreachable → fork kgen.py
+  KWORKER_PREVIEW   "0" to skip the ``kgen --preview`` draft  (default 1)
+  KWORKER_STREAM    "0" to upload the final render only once it's finished
+                    (default 1: fragmented MP4, uploaded while it encodes)
+  KWORKER_CHUNK_MB  upload chunk size for streaming  (default 4)
+  KWORKER_ID        worker id for leases/heartbeats  (default <hostname>-<pid>)
+  KWORKER_SPOOL     the server's spool directory as mounted on this host, for
+                    co-located workers: renders are written there and handed
+                    off by rename instead of uploaded (checked at startup;
+                    falls back to HTTP if the server can't see our files)
+  KWORKER_SLOTS     jobs held at once  (default: busiest heavy stage's slots + 1)
+  KWORKER_STAGES    per-stage task limits, e.g. "separate=1,align=2,burn=1"
+                    (default from memory and cores; see stage_slots)
 """
 
 import os
 import re
 import sys
 import time
+import socket
+import queue
+import hashlib
+import contextlib
 import shutil
 import tempfile
 import logging
+import threading
 import subprocess
 
 import requests
@@ -54,6 +94,21 @@ WORKDIR = os.environ.get("KWORKER_WORKDIR", "/tmp/kworker")
 VERIFY = os.environ.get("KWORKER_INSECURE", "") not in ("1", "true", "True", "yes")
 GUIDE_VOL = os.environ.get("KWORKER_GUIDE_VOL", "0.08")
 MODEL = os.environ.get("KWORKER_MODEL", "")          # whisper model; "" → kgen's default
+# whisper models this worker can load (kgen fetches any of them on first use);
+# the large ones are only offered with the memory for them (see LARGE_GB)
+MODELS = os.environ.get("KWORKER_MODELS", "tiny,base,small,medium,large-v2,large-v3,turbo")
+STEM_CACHE = os.environ.get("KWORKER_STEM_CACHE", "")  # "" → kgen's default store
+KGEN_SOCKET = os.environ.get("KWORKER_KGEN_SOCKET", "")  # "" → fork kgen.py per job
+PREVIEW = os.environ.get("KWORKER_PREVIEW", "1") not in ("0", "false", "False", "no")
+STREAM = os.environ.get("KWORKER_STREAM", "1") not in ("0", "false", "False", "no")
+CHUNK = int(float(os.environ.get("KWORKER_CHUNK_MB", "4")) * (1 << 20))
+WORKER_ID = os.environ.get("KWORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+HEARTBEAT = 15                                          # s between lease renewals (server lease: 60 s)
+SPOOL = os.environ.get("KWORKER_SPOOL", "")             # "" → always upload over HTTP
+_spool = None                                           # SPOOL once the server has confirmed it
+SLOTS = int(os.environ.get("KWORKER_SLOTS", "0"))       # 0 → from the stage slots (see main)
+STAGES_ENV = os.environ.get("KWORKER_STAGES", "")       # per-stage slot overrides, "separate=2,burn=1"
+_slots = 1                                              # jobs held at once, advertised when polling
 
 _YT_ID = re.compile(r"(?:v=|/embed/|/v/|youtu\.be/|/shorts/)([A-Za-z0-9_-]{11})")
 
@@ -63,11 +118,22 @@ def _video_id(url):
     return m.group(1) if m else None
 
 
+def capacity():
+    """What this worker advertises when polling (the server matches jobs to it)."""
+    mem = _mem_gb()
+    models = [m for m in MODELS.split(",") if m and (mem * MEM_SHARE >= _align_gb(m) or m == MODEL)]
+    if MODEL and MODEL not in models:
+        models.append(MODEL)
+    return {"worker": WORKER_ID, "slots": _slots, "cores": os.cpu_count() or 1,
+            "mem": f"{mem:.0f}", "models": ",".join(models)}
+
+
 def poll_task():
     """Block until the server hands out a job; returns the work list."""
+    params = capacity()
     while True:
         try:
-            r = requests.get(f"{SERVER}/poll_task", timeout=90, verify=VERIFY)
+            r = requests.get(f"{SERVER}/poll_task", params=params, timeout=90, verify=VERIFY)
             if r.status_code == 200:
                 data = r.json()
                 if data:                      # non-empty → a real job
@@ -118,78 +184,527 @@ def caption_lrc(url, caps, dest):
         return None
 
 
-def add_accompaniment(karaoke, workdir, dest):
-    """Mux a 2nd audio track (accompaniment + faint vocal guide) into the burned
-    karaoke video, reusing the Spleeter stems kgen left in ``workdir``.
+def _timing_field(timing):
+    """kgen's word-timing JSON as a form field ({} if it wrote none)."""
+    if timing and os.path.exists(timing):
+        with open(timing, encoding="utf-8") as f:
+            return {"timing": f.read()}
+    return {}
 
-    Falls back to the single-track karaoke file if the stems aren't present.
-    """
-    acc = os.path.join(workdir, "accompaniment.wav")
-    voc = os.path.join(workdir, "vocals.wav")
-    if not (os.path.exists(acc) and os.path.exists(voc)):
-        log.info("stems not found in workdir — keeping single audio track")
-        return karaoke
-    mixed = os.path.join(workdir, "mixed.wav")
-    subprocess.run([
-        "ffmpeg", "-y", "-i", acc, "-i", voc, "-filter_complex",
-        f"[0:a]volume=1.0[a0];[1:a]volume={GUIDE_VOL}[a1];[a0][a1]amix=inputs=2:duration=longest[out]",
-        "-map", "[out]", "-c:a", "pcm_s16le", "-loglevel", "error", mixed,
-    ], check=True)
-    subprocess.run([
-        "ffmpeg", "-y", "-i", karaoke, "-i", mixed,
-        "-map", "0:v:0", "-map", "0:a:0", "-map", "1:a:0",
-        "-c:v", "copy", "-c:a", "aac",
-        "-metadata:s:a:0", "title=Vocal", "-metadata:s:a:1", "title=Accompaniment",
-        "-loglevel", "error", dest,
-    ], check=True)
-    return dest
+
+def _sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
 
 
-def submit_task(uuid, path):
-    """Upload the finished video to the server (multipart: uuid + file)."""
+def submit_task(uuid, path, kind="final", timing=None, render=None):
+    """Upload a rendered video to the server (multipart: uuid + kind [+ timing]
+    [+ render params] + sha256 + file); the server checks the hash before
+    taking the file. `render` ({model, guide_vol}) goes to its render registry."""
     with open(path, "rb") as f:
         data = encoder.MultipartEncoder(fields={
             "uuid": uuid,
+            "worker": WORKER_ID,
+            "kind": kind,
+            **_timing_field(timing),
+            **(render or {}),
+            "sha256": _sha256(path),
             "file_content": ("output.mp4", f, "video/mp4"),
         })
         r = requests.post(f"{SERVER}/submit_task", data=data,
                           headers={"Content-Type": data.content_type}, verify=VERIFY)
     r.raise_for_status()
-    log.info("submitted %s (HTTP %s)", uuid, r.status_code)
-
-
-def process(job, work):
-    """Render one job end-to-end and submit it. Raises on any failure."""
-    uuid, url, title, singer = job[1], job[2], job[3], job[4]
-    caps = job[5] if len(job) > 5 else None
-    log.info("job %s — %r by %r%s", uuid, title, singer, f" (caps={caps})" if caps else "")
-
-    inp = os.path.join(work, "input.mp4")
-    karaoke = os.path.join(work, "karaoke.mp4")
-    kgdir = os.path.join(work, "kg")
-    download(url, inp)
-
-    cmd = [sys.executable, KGEN, inp, "--out", karaoke,
-           "--ass", os.path.join(work, "karaoke.ass"), "--workdir", kgdir]
-    if MODEL:
-        cmd += ["--model", MODEL]
-    if title:
-        cmd += ["--title", title]
-    if singer:
-        cmd += ["--artist", singer]
+    log.info("submitted %s %s (HTTP %s)", kind, uuid, r.status_code)
+
+
+def _post_chunk(uuid, path, offset, size, final, timing=None, sha=None, render=None):
+    """Upload bytes [offset, offset+size) of `path` as one chunk of a streamed
+    final upload; returns the new offset. `sha` hashes the chunks as they go,
+    and the last one carries its digest, the word timing and render params."""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read(size)
+    if sha:
+        sha.update(data)
+    body = encoder.MultipartEncoder(fields={
+        "uuid": uuid,
+        "worker": WORKER_ID,
+        "kind": "final",
+        "offset": str(offset),
+        "final": "1" if final else "0",
+        **(_timing_field(timing) if final else {}),
+        **((render or {}) if final else {}),
+        **({"sha256": sha.hexdigest()} if final and sha else {}),
+        "file_content": ("output.mp4", data, "video/mp4"),
+    })
+    r = requests.post(f"{SERVER}/submit_task", data=body,
+                      headers={"Content-Type": body.content_type}, verify=VERIFY)
+    r.raise_for_status()
+    return offset + len(data)
+
+
+def stream_task(uuid, path, done, abort, timing=None, render=None):
+    """Upload `path` while kgen is still writing it (fragmented MP4, so the file
+    only ever grows): every CHUNK bytes as they land, the rest once `done` is
+    set, with ``final=1`` on the last chunk — the server registers the song then.
+    If `abort` is set instead, stop without finalizing."""
+    offset, t0, sha = 0, time.time(), hashlib.sha256()
+    while True:
+        finished = done.is_set()      # read before the size: once set, the file is complete
+        if abort.is_set():
+            log.info("stream upload of %s aborted at %d bytes", uuid, offset)
+            return
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        while size - offset >= CHUNK:
+            offset = _post_chunk(uuid, path, offset, CHUNK, False, sha=sha)
+        if finished:
+            t_end = time.time()
+            offset = _post_chunk(uuid, path, offset, size - offset, True, timing, sha, render)
+            log.info("streamed final %s: %.1f MB over %.0fs, done %.1fs after the render",
+                     uuid, offset / (1 << 20), time.time() - t0, time.time() - t_end)
+            return
+        time.sleep(1)
+
+
+def negotiate_spool():
+    """Co-located fast path: prove SPOOL is the server's spool directory by
+    writing the server's nonce into a probe file there and having the server
+    read it back. Returns the directory, or None (upload over HTTP)."""
+    if not SPOOL:
+        return None
+    probe = os.path.join(SPOOL, f".probe-{WORKER_ID}")
+    ok = False
+    try:
+        nonce = requests.get(f"{SERVER}/spool", timeout=10, verify=VERIFY).json()["nonce"]
+        with open(probe, "w") as f:
+            f.write(nonce)
+        ok = requests.post(f"{SERVER}/spool", json={"name": os.path.basename(probe)},
+                           timeout=10, verify=VERIFY).json().get("ok", False)
+    except Exception as e:
+        log.warning("spool check failed (%s)", e)
+    finally:
+        with contextlib.suppress(OSError):
+            os.remove(probe)
+    log.info("spool %s: %s", SPOOL, "shared with the server — handing off by rename" if ok
+             else "not visible to the server — uploading over HTTP")
+    return SPOOL if ok else None
+
+
+def handoff(uuid, path, kind="final", timing=None, render=None):
+    """Hand a render written into the spool to the server, which renames it
+    into place (multipart: uuid + kind [+ timing] [+ render params] + spool
+    file name, no body)."""
+    data = encoder.MultipartEncoder(fields={
+        "uuid": uuid,
+        "worker": WORKER_ID,
+        "kind": kind,
+        **_timing_field(timing),
+        **(render or {}),
+        "spool": os.path.basename(path),
+    })
+    r = requests.post(f"{SERVER}/submit_task", data=data,
+                      headers={"Content-Type": data.content_type}, verify=VERIFY)
+    r.raise_for_status()
+    log.info("handed off %s %s via the spool (HTTP %s)", kind, uuid, r.status_code)
+
+
+def deliver(uuid, path, kind="final", timing=None, render=None):
+    """Spool handoff for a file rendered into the spool, else (or if that
+    fails) a normal upload."""
+    if _spool and os.path.dirname(path) == _spool:
+        try:
+            return handoff(uuid, path, kind, timing, render)
+        except Exception as e:
+            log.warning("job %s: spool handoff failed (%s); uploading over HTTP", uuid, e)
+    submit_task(uuid, path, kind, timing, render)
+
+
+def _beat(uuid, state):
+    r = requests.post(f"{SERVER}/heartbeat", json={"worker": WORKER_ID, "uuid": uuid, "state": state},
+                      timeout=10, verify=VERIFY)
+    return r.status_code
+
+
+def lease(uuid):
+    """Renew the job's lease every HEARTBEAT s from a background thread until
+    the returned ``stop(failed=False)`` is called. ``failed=True`` hands the job
+    back (``state=failed``) so the server requeues it now rather than when the
+    lease runs out."""
+    halt = threading.Event()
+
+    def beat():
+        while not halt.wait(HEARTBEAT):
+            try:
+                code = _beat(uuid, "running")
+            except Exception as e:
+                log.warning("heartbeat failed (%s)", e)
+                continue
+            if code == 404:                             # server without leases
+                return
+            if code == 409:
+                log.warning("job %s: lease lost — the server has requeued it", uuid)
+
+    t = threading.Thread(target=beat, name=f"heartbeat-{uuid[:8]}", daemon=True)
+    t.start()
+
+    def stop(failed=False):
+        halt.set()
+        t.join()
+        if failed:
+            try:
+                _beat(uuid, "failed")
+            except Exception:
+                pass
+    return stop
+
+
+def _kgen_module():
+    """Import kgen.py from KWORKER_KGEN (cheap: its heavy imports are lazy)."""
+    import importlib.util
+    spec = importlib.util.spec_from_file_location("kgen", KGEN)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+_kgen_defaults = {}
+
+
+def kgen_default_model():
+    """The whisper model kgen uses when not given --model (its real name, so
+    the server's render registry can match requests that name it)."""
+    if "model" not in _kgen_defaults:
+        _kgen_defaults["model"] = _kgen_module().build_parser().get_default("model")
+    return _kgen_defaults["model"]
+
+
+def run_kgen(args):
+    """Render with kgen — on the resident ``kgen serve`` if one is configured and
+    listening (no per-job model load), else as a fresh subprocess."""
+    if KGEN_SOCKET:
+        try:
+            log.info("submitting to kgen server %s: %s", KGEN_SOCKET, " ".join(args))
+            _kgen_module().submit(args, sock=KGEN_SOCKET, log=lambda l: log.info("kgen| %s", l))
+            return
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            log.warning("kgen server unavailable (%s); forking kgen.py instead", e)
+    cmd = [sys.executable, KGEN] + args
+    log.info("running: %s", " ".join(cmd))
+    subprocess.run(cmd, check=True)                    # non-zero exit → job fails
+
+
+# ------------------------------------------------------------------ pipeline
+# A job goes download → preview → separate → align → burn → upload, each stage with its
+# own threads and a bounded queue in front, so the next job downloads while
+# this one renders and one uploads while the next burns. A task's stage needs
+# STAGE_GB of memory: Spleeter and Whisper are the heavy ones (the burn is
+# CPU-bound), and every stage that runs kgen draws on one MemoryBudget, so a
+# separation and an alignment only run side by side when both fit.
+
+STAGES = ("download", "preview", "separate", "align", "burn", "upload")
+STAGE_GB = {"download": 0.2, "preview": 1.5, "separate": 4.0, "align": 3.0, "burn": 1.0, "upload": 0.2}
+BUDGETED = ("preview", "separate", "align", "burn")   # the stages that run kgen
+ALIGN_GB = {"tiny": 1.0, "base": 1.5, "small": 3.0, "medium": 5.0, "turbo": 6.0}   # large*: LARGE_GB
+LARGE_GB = 10.0
+MEM_SHARE = 0.8                 # of physical memory the heavy stages may use
+QUEUE_DEPTH = 1                 # jobs waiting in front of a stage (beyond its running ones)
+REPORT = 60                     # s between stage utilization reports
+
+
+def _mem_gb():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / (1 << 30)
+    except (ValueError, OSError):
+        return 0
+
+
+def _align_gb(model):
+    model = model or "small"                            # kgen's default
+    return LARGE_GB if model.startswith("large") else ALIGN_GB.get(model, STAGE_GB["align"])
+
+
+def stage_slots(mem, cores):
+    """Tasks each stage runs at once: as many separations / alignments as the
+    memory budget holds (and the cores can feed), one burn per 8 cores.
+    ``KWORKER_STAGES`` ("separate=2,burn=1") overrides any of them."""
+    budget = mem * MEM_SHARE
+    slots = {"download": 2, "upload": 2, "preview": 1,
+             "separate": max(1, min(int(budget // STAGE_GB["separate"]), cores // 4)),
+             "align": max(1, min(int(budget // _align_gb(MODEL)), cores // 4)),
+             "burn": max(1, cores // 8)}
+    for item in filter(None, STAGES_ENV.split(",")):
+        name, _, n = item.partition("=")
+        if name.strip() not in slots:
+            raise SystemExit(f"KWORKER_STAGES: unknown stage {name!r} (one of {', '.join(STAGES)})")
+        slots[name.strip()] = max(1, int(n))
+    return slots
+
+
+class MemoryBudget:
+    """GB handed out to running stage tasks. A task bigger than the whole
+    budget still runs, but alone."""
+
+    def __init__(self, gb):
+        self.gb, self.used = gb, 0.0
+        self._cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def hold(self, gb):
+        with self._cond:
+            self._cond.wait_for(lambda: self.used == 0 or self.used + gb <= self.gb)
+            self.used += gb
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.used -= gb
+                self._cond.notify_all()
+
+
+class Job:
+    """A leased job on its way through the pipeline: its paths, the kgen
+    arguments the stages share, and its lease."""
+
+    def __init__(self, row):
+        self.row = row
+        self.uuid, self.url, self.title, self.singer = row[1], row[2], row[3], row[4]
+        self.caps = row[5] if len(row) > 5 else None
+        # the job may ask for a model / guide volume; else this worker's defaults
+        params = row[6] if len(row) > 6 and row[6] else {}
+        self.model = params.get("model") or MODEL or kgen_default_model()
+        self.guide_vol = float(GUIDE_VOL if params.get("guide_vol") is None else params["guide_vol"])
+        self.work = tempfile.mkdtemp(prefix="job_", dir=WORKDIR)
+        self.inp = os.path.join(self.work, "input.mp4")
+        self.kgdir = os.path.join(self.work, "kg")
+        self.ass = os.path.join(self.work, "karaoke.ass")
+        self.timing = os.path.join(self.work, "karaoke.timing.json")   # kgen writes it next to the ASS
+        # co-located: render straight into the server's spool, so delivery is a rename
+        out = _spool or self.work
+        self.final = os.path.join(out, f"{self.uuid}.mp4" if _spool else "final.mp4")
+        self.preview = os.path.join(out, f"{self.uuid}.preview.mp4" if _spool else "preview.mp4")
+        self.song = []              # kgen input + lyric arguments, set by the download stage
+        self.stem_key = None        # the input's stem-store key, once separation has hashed it
+        self.upload = None          # (thread, errors) of a streamed final upload
+        self.times = {}             # stage -> seconds it ran
+        self.start = time.time()
+        self.stop_lease = lease(self.uuid)
+
+    @property
+    def render(self):
+        # what the server's render registry records for the final
+        return {"model": self.model, "guide_vol": str(self.guide_vol)}
+
+    def heavy(self):
+        # kgen options for the stages that separate / align
+        return ["--model", self.model] + (["--stem-cache", STEM_CACHE] if STEM_CACHE else [])
+
+    def close(self, failed=False):
+        self.stop_lease(failed)
+        if _spool:                                      # left behind only if delivery didn't happen
+            for p in (self.final, self.preview):
+                with contextlib.suppress(OSError):
+                    os.remove(p)
+        shutil.rmtree(self.work, ignore_errors=True)
+
+
+def do_download(job):
+    """Fetch the video and the chosen caption track."""
+    log.info("job %s — %r by %r%s", job.uuid, job.title, job.singer,
+             f" (caps={job.caps})" if job.caps else "")
+    download(job.url, job.inp)
+    job.song = [job.inp, "--workdir", job.kgdir]
+    if job.title:
+        job.song += ["--title", job.title]
+    if job.singer:
+        job.song += ["--artist", job.singer]
     # a chosen YouTube caption is a *video-synced* subtitle → kgen trusts its line
     # timings and only word-aligns locally
-    lrc = caption_lrc(url, caps, os.path.join(work, "caps.lrc")) if caps else None
+    lrc = caption_lrc(job.url, job.caps, os.path.join(job.work, "caps.lrc")) if job.caps else None
     if lrc:
-        cmd += ["--subtitle", lrc]
+        job.song += ["--subtitle", lrc]
+
+
+def do_preview(job):
+    """Render and deliver the seconds-fast draft, so the requester can check
+    it's the right song/lyrics while the full render runs; the final upload
+    replaces it."""
+    if PREVIEW:
+        try:
+            run_kgen(job.song + ["--preview", "--out", job.preview,
+                                 "--ass", os.path.join(job.work, "preview.ass")])
+            deliver(job.uuid, job.preview, kind="preview",
+                    timing=os.path.join(job.work, "preview.timing.json"))
+        except Exception as e:
+            log.warning("job %s: preview failed (%s); continuing with the full render", job.uuid, e)
 
-    log.info("running: %s", " ".join(cmd))
-    subprocess.run(cmd, check=True)                    # non-zero exit → job fails
-    if not os.path.exists(karaoke):
-        raise RuntimeError("kgen produced no output file")
 
-    final = add_accompaniment(karaoke, kgdir, os.path.join(work, "final.mp4"))
-    submit_task(uuid, final)
+def do_separate(job):
+    # stems land in the job's kgen workdir (and the shared stem store)
+    run_kgen(job.song + ["--separate-only"] + job.heavy())
+    with contextlib.suppress(OSError), open(os.path.join(job.kgdir, "stem.key")) as f:
+        job.stem_key = f.read().strip()
+
+
+def do_align(job):
+    # reuses the stems (by key: no second decode + hash of the input); writes
+    # the ASS and its word timing
+    key = ["--stem-key", job.stem_key] if job.stem_key else []
+    run_kgen(job.song + ["--no-burn", "--ass", job.ass] + key + job.heavy())
+
+
+def do_burn(job):
+    """Burn the ASS and mux both audio tracks in one ffmpeg run. Streaming, the
+    output is fragmented and an upload thread sends it while it encodes; the
+    upload stage waits for that thread."""
+    cmd = job.song + ["--burn-only", "--ass", job.ass, "--out", job.final,
+                      "--guide-vol", str(job.guide_vol)]
+    if _spool or not STREAM:
+        run_kgen(cmd)
+        if not os.path.exists(job.final):
+            raise RuntimeError("kgen produced no output file")
+        return
+
+    done, abort, err = threading.Event(), threading.Event(), []
+    def upload():
+        try:
+            stream_task(job.uuid, job.final, done, abort, job.timing, job.render)
+        except Exception as e:
+            err.append(e)
+    up = threading.Thread(target=upload, name=f"upload-{job.uuid[:8]}", daemon=True)
+    up.start()
+    try:
+        run_kgen(cmd + ["--fragmented"])
+        if not os.path.exists(job.final):
+            raise RuntimeError("kgen produced no output file")
+    except BaseException:
+        abort.set()
+        done.set()
+        up.join()
+        raise
+    done.set()
+    job.upload = (up, err)
+
+
+def do_upload(job):
+    if job.upload is None:
+        deliver(job.uuid, job.final, kind="final", timing=job.timing, render=job.render)
+        return
+    up, err = job.upload
+    up.join()
+    if err:
+        log.warning("job %s: streamed upload failed (%s); uploading the whole file", job.uuid, err[0])
+        submit_task(job.uuid, job.final, kind="final", timing=job.timing, render=job.render)
+
+
+STAGE_RUN = {"download": do_download, "preview": do_preview, "separate": do_separate,
+             "align": do_align, "burn": do_burn, "upload": do_upload}
+
+
+class Pipeline:
+    """Stage threads fed by bounded queues, and the poller that leases jobs
+    into them. At most `jobs` jobs are held at once (what we advertise to the
+    server as ``slots``): the one(s) rendering plus those prefetched."""
+
+    def __init__(self, slots, jobs, budget_gb):
+        self.slots, self.jobs = slots, jobs
+        self.budget = MemoryBudget(budget_gb)
+        self.queues = {s: queue.Queue(QUEUE_DEPTH) for s in STAGES}
+        self.held = threading.Semaphore(jobs)
+        self.lock = threading.Lock()
+        self.since = time.time()                    # start of the current report window
+        self.busy = dict.fromkeys(STAGES, 0.0)      # s of finished work in the window
+        self.active = {s: {} for s in STAGES}       # uuid -> start of its running task
+        self.done = dict.fromkeys(STAGES, 0)
+
+    def need(self, stage, job):
+        # GB a task holds from the budget; the light stages don't wait on it
+        if stage == "align":
+            return _align_gb(job.model)
+        return STAGE_GB[stage] if stage in BUDGETED else 0
+
+    def worker(self, stage):
+        nxt = STAGES[STAGES.index(stage) + 1] if stage != STAGES[-1] else None
+        while True:
+            job = self.queues[stage].get()
+            try:
+                with self.budget.hold(self.need(stage, job)):
+                    t0 = time.time()
+                    with self.lock:
+                        self.active[stage][job.uuid] = t0
+                    try:
+                        STAGE_RUN[stage](job)
+                    finally:
+                        now = time.time()
+                        job.times[stage] = now - t0
+                        with self.lock:
+                            del self.active[stage][job.uuid]
+                            self.busy[stage] += now - max(t0, self.since)
+                            self.done[stage] += 1
+            except subprocess.CalledProcessError as e:
+                log.error("job %s: %s failed (exit %s); handed back to the server",
+                          job.uuid, stage, e.returncode)
+                self.finish(job, failed=True)
+                continue
+            except Exception as e:
+                log.exception("job %s: %s failed (%s); handed back to the server", job.uuid, stage, e)
+                self.finish(job, failed=True)
+                continue
+            if nxt:
+                self.queues[nxt].put(job)               # blocks while the next stage is backed up
+            else:
+                self.finish(job)
+
+    def finish(self, job, failed=False):
+        try:
+            job.close(failed)
+        finally:
+            self.held.release()
+        if not failed:
+            log.info("job %s done in %.0fs (%s)", job.uuid, time.time() - job.start,
+                     ", ".join(f"{s} {job.times[s]:.0f}s" for s in STAGES if s in job.times))
+
+    def utilization(self):
+        """Per stage: the share of its slots kept busy since the last call
+        (running tasks count up to now), with run/queued/done counts; starts
+        a new window."""
+        with self.lock:
+            now = time.time()
+            stats = {}
+            for s in STAGES:
+                busy = self.busy[s] + sum(now - max(t0, self.since) for t0 in self.active[s].values())
+                stats[s] = (busy / (max(now - self.since, 1e-6) * self.slots[s]),
+                            len(self.active[s]), self.queues[s].qsize(), self.done[s])
+                self.busy[s] = 0.0
+            self.since = now
+        return stats
+
+    def report(self):
+        while True:
+            time.sleep(REPORT)
+            stats = self.utilization()
+            log.info("stages: %s  mem %.1f/%.0f GB", " · ".join(
+                f"{s} {util:.0%}/{self.slots[s]} (run {run}, queued {queued}, done {done})"
+                for s, (util, run, queued, done) in stats.items()), self.budget.used, self.budget.gb)
+
+    def run(self):
+        for stage in STAGES:
+            for i in range(self.slots[stage]):
+                threading.Thread(target=self.worker, args=(stage,), name=f"{stage}-{i}", daemon=True).start()
+        threading.Thread(target=self.report, name="report", daemon=True).start()
+        while True:
+            self.held.acquire()                         # a free job slot → lease the next job now
+            row = poll_task()
+            try:
+                job = Job(row)
+            except Exception as e:
+                log.exception("job %s: setup failed (%s)", row[1] if len(row) > 1 else "?", e)
+                self.held.release()
+                time.sleep(1)
+                continue
+            self.queues["download"].put(job)
 
 
 def main():
@@ -197,21 +712,15 @@ def main():
     if not os.path.exists(KGEN):
         log.error("kgen.py not found at %s (set KWORKER_KGEN)", KGEN)
         sys.exit(1)
-    log.info("worker online → %s  (kgen=%s, verify=%s)", SERVER, KGEN, VERIFY)
-    while True:
-        job = poll_task()
-        uuid = job[1] if len(job) > 1 else "?"
-        work = tempfile.mkdtemp(prefix="job_", dir=WORKDIR)
-        try:
-            process(job, work)
-        except subprocess.CalledProcessError as e:
-            log.error("job %s: a subprocess failed (exit %s); server will mark it Failed on next poll",
-                      uuid, e.returncode)
-        except Exception as e:
-            log.exception("job %s failed (%s); server will mark it Failed on next poll", uuid, e)
-        finally:
-            shutil.rmtree(work, ignore_errors=True)
-        time.sleep(1)                                   # re-poll → flush success/failure state
+    global _spool, _slots
+    mem, cores = _mem_gb(), os.cpu_count() or 1
+    slots = stage_slots(mem, cores)
+    _slots = SLOTS or max(slots["separate"], slots["align"], slots["burn"]) + 1
+    log.info("worker %s online → %s  (kgen=%s, verify=%s)", WORKER_ID, SERVER, KGEN, VERIFY)
+    log.info("pipeline: %d jobs at once, stage slots %s, %.0f GB for the heavy stages",
+             _slots, slots, mem * MEM_SHARE)
+    _spool = negotiate_spool()
+    Pipeline(slots, _slots, mem * MEM_SHARE).run()
 
 
 if __name__ == "__main__":
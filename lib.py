@@ -1,15 +1,168 @@
+import errno
 import fractions
+import logging
 import av
 import threading
 from typing import Dict, Optional, Set
 from aiortc.mediastreams import AUDIO_PTIME, MediaStreamError, MediaStreamTrack, VIDEO_PTIME
-from aiortc.contrib.media import player_worker_decode as player_worker, REAL_TIME_FORMATS, PlayerStreamTrack
+from aiortc.contrib.media import REAL_TIME_FORMATS, PlayerStreamTrack
 import time
 
 import asyncio
 from av.audio.frame import AudioFrame
+from av.video.frame import VideoFrame
 from av.frame import Frame
 
+logger = logging.getLogger(__name__)
+
+
+class AssOverlay:
+    """
+    Draws an ASS subtitle file onto decoded video frames with libass, through a
+    PyAV filter graph (buffer -> ass -> buffersink), in the player's decode
+    worker.
+
+    The overlay is best-effort: a frame is passed through untouched when the
+    worker is already behind real time, or when rendering has recently cost
+    more than ``budget`` of a frame interval (then the overlay is suspended
+    for ``hold`` seconds before being tried again). Pacing never waits on libass.
+    If the filter graph fails, the overlay is switched off for the rest of the
+    song and frames pass through, so the decode worker keeps running.
+
+    :param stream: The video stream whose decoded frames will be overlaid.
+    :param ass: The path to the ASS file.
+    """
+
+    def __init__(self, stream, ass, budget=0.5, hold=2.0):
+        self.graph = av.filter.Graph()
+        src = self.graph.add_buffer(template=stream)
+        esc = ass.replace("\\", "\\\\").replace(":", "\\:").replace("'", "\\'")
+        sub = self.graph.add("ass", f"filename='{esc}'")
+        sink = self.graph.add("buffersink")
+        src.link_to(sub)
+        sub.link_to(sink)
+        self.graph.configure()
+
+        rate = stream.average_rate or stream.guessed_rate or 30
+        self.budget = budget / float(rate)
+        self.hold = hold
+        self.cost = 0.0           # moving average of the render time per frame
+        self.resume_at = None     # frame time at which a suspended overlay is retried
+        self.samples = 0          # frames in `cost` since it was last reset
+        self.failed = False
+        self.drawn = 0
+        self.dropped = 0
+
+    def apply(self, frame: VideoFrame, late: bool) -> VideoFrame:
+        if self.failed or late or (self.resume_at is not None and frame.time < self.resume_at):
+            self.dropped += 1
+            return frame
+        self.resume_at = None
+        t0 = time.perf_counter()
+        try:
+            self.graph.push(frame)
+            out = self.graph.pull()
+        except Exception as exc:
+            logger.error("overlay failed (%s); showing the video without it", exc)
+            self.failed = True
+            self.dropped += 1
+            return frame
+        out.pts, out.time_base = frame.pts, frame.time_base
+        self.cost = 0.9 * self.cost + 0.1 * (time.perf_counter() - t0) if self.samples else time.perf_counter() - t0
+        self.samples += 1
+        self.drawn += 1
+        if self.cost > self.budget:
+            logger.warning("overlay %.1fms/frame over the %.1fms budget; suspended for %.0fs",
+                           self.cost * 1000, self.budget * 1000, self.hold)
+            self.resume_at = frame.time + self.hold
+            self.cost = 0.0
+            self.samples = 0
+        return out
+
+
+def player_worker(
+    loop,
+    container,
+    streams,
+    audio_track,
+    video_track,
+    quit_event,
+    throttle_playback,
+    loop_playback,
+    overlay=None,
+):
+    """
+    aiortc's ``player_worker_decode``, plus the optional :class:`AssOverlay` on
+    video frames (before their pts are rebased, so libass sees song time).
+    """
+    audio_sample_rate = 48000
+    audio_samples = 0
+    audio_time_base = fractions.Fraction(1, audio_sample_rate)
+    audio_resampler = av.AudioResampler(
+        format="s16",
+        layout="stereo",
+        rate=audio_sample_rate,
+        frame_size=int(audio_sample_rate * AUDIO_PTIME),
+    )
+
+    video_first_pts = None
+
+    frame_time = None
+    start_time = time.time()
+
+    while not quit_event.is_set():
+        try:
+            frame = next(container.decode(*streams))
+        except Exception as exc:
+            if isinstance(exc, av.FFmpegError) and exc.errno == errno.EAGAIN:
+                time.sleep(0.01)
+                continue
+            if isinstance(exc, StopIteration) and loop_playback:
+                container.seek(0)
+                continue
+            if audio_track:
+                asyncio.run_coroutine_threadsafe(audio_track._queue.put(None), loop)
+            if video_track:
+                asyncio.run_coroutine_threadsafe(video_track._queue.put(None), loop)
+            break
+
+        # read up to 1 second ahead
+        elapsed_time = time.time() - start_time
+        if throttle_playback:
+            if frame_time and frame_time > elapsed_time + 1:
+                time.sleep(0.1)
+
+        if isinstance(frame, AudioFrame) and audio_track:
+            for frame in audio_resampler.resample(frame):
+                # fix timestamps
+                frame.pts = audio_samples
+                frame.time_base = audio_time_base
+                audio_samples += frame.samples
+
+                frame_time = frame.time
+                asyncio.run_coroutine_threadsafe(audio_track._queue.put(frame), loop)
+        elif isinstance(frame, VideoFrame) and video_track:
+            if frame.pts is None:  # pragma: no cover
+                logger.warning(
+                    "MediaPlayer(%s) Skipping video frame with no pts", container.name
+                )
+                continue
+
+            if overlay:
+                # behind real time: the frame is due already, send it bare
+                frame = overlay.apply(frame, late=frame.time < elapsed_time)
+
+            # video from a webcam doesn't start at pts 0, cancel out offset
+            if video_first_pts is None:
+                video_first_pts = frame.pts
+            frame.pts -= video_first_pts
+
+            frame_time = frame.time
+            asyncio.run_coroutine_threadsafe(video_track._queue.put(frame), loop)
+
+    if overlay and (overlay.drawn or overlay.dropped):
+        logger.info("overlay: %d frames drawn, %d passed through", overlay.drawn, overlay.dropped)
+
 
 class MediaPlayer:
     """
@@ -46,9 +199,11 @@ class MediaPlayer:
     :param format: The format to use, defaults to autodect.
     :param options: Additional options to pass to FFmpeg.
     :param loop: Whether to repeat playback indefinitely (requires a seekable file).
+    :param audio: Which audio stream to play (the video is only opened for 0).
+    :param overlay: The path to an ASS file to draw onto the video (see :class:`AssOverlay`).
     """
 
-    def __init__(self, file, format=None, options={}, loop=False, audio=0):
+    def __init__(self, file, format=None, options={}, loop=False, audio=0, overlay=None):
         self.__container = av.open(file=file, format=format, mode="r", options=options)
         self.__thread: Optional[threading.Thread] = None
         self.__thread_quit: Optional[threading.Event] = None
@@ -70,6 +225,14 @@ class MediaPlayer:
                 self.__video = PlayerStreamTrack(self, kind="video")
                 self.__streams.append(stream)
 
+        self.__overlay = None
+        if overlay and self.__video:
+            video_stream = [s for s in self.__streams if s.type == "video"][0]
+            try:
+                self.__overlay = AssOverlay(video_stream, overlay)
+            except Exception as exc:
+                logger.warning("MediaPlayer(%s) no lyric overlay: %s", file, exc)
+
         # check whether we need to throttle playback
         container_format = set(self.__container.format.name.split(","))
         self._throttle_playback = not container_format.intersection(REAL_TIME_FORMATS)
@@ -94,6 +257,13 @@ class MediaPlayer:
         """
         return self.__video
 
+    @property
+    def overlay(self) -> bool:
+        """
+        Whether an ASS overlay is being drawn onto the video.
+        """
+        return self.__overlay is not None
+
     def _start(self, track: PlayerStreamTrack) -> None:
         self.__started.add(track)
         if self.__thread is None:
@@ -111,6 +281,7 @@ class MediaPlayer:
                     self.__thread_quit,
                     self._throttle_playback,
                     self._loop_playback,
+                    self.__overlay,
                 ),
             )
             self.__thread.start()
@@ -1,6 +1,7 @@
 import argparse
 import asyncio
 import json
+import re
 import logging
 import os
 import ssl
@@ -8,6 +9,9 @@ import fractions
 import gc
 import aiofiles
 import uuid
+import tempfile
+import shutil
+import errno
 from aiohttp import web
 
 from aiortc.mediastreams import MediaStreamTrack, Frame
@@ -15,6 +19,9 @@ from aiortc import RTCPeerConnection, RTCSessionDescription, VideoStreamTrack
 from aiortc.contrib.media import MediaRelay, MediaStreamError
 
 from lib import MediaPlayer, AudioStreamTrack
+from kgen import read_timing, write_ass, FONT
+from jobqueue import JobQueue, RenderRegistry
+import ingest
 
 from av import VideoFrame, AudioFrame
 # from yt_agent import init as yt_init, add_task, get_work_list, uninit as yt_uninit, video_info
@@ -22,6 +29,10 @@ from yt_agent import video_info
 import time
 
 OUTPUT_DIR = '/media/downloads'
+SPOOL_DIR = os.path.join(OUTPUT_DIR, '.spool') # co-located workers render here (same filesystem → rename)
+SPOOL_NONCE = uuid.uuid4().hex # a worker proves it shares SPOOL_DIR by writing this into it
+OVERLAY_DIR = os.path.join(tempfile.gettempdir(), 'kortc-overlay') # ASS rendered from timing sidecars
+OVERLAY = 'server' # who draws lyrics that aren't burned in: server (libass on the stream) | client (TV page)
 
 from db import query, path_wrapper, get_song_by_id, preload, get_singers, increase_click_count, add_song
 
@@ -36,7 +47,30 @@ relay = None
 webcam = None
 singers  = []
 
-workset = [] # [[stage, uuid, url, title, singer, caps, path]]
+jobs = JobQueue() # leases, heartbeats, persistence: see jobqueue.py
+renders = RenderRegistry() # finished YouTube renders, reused by repeat requests
+workset = jobs.tasks # [[stage, uuid, url, title, singer, caps]]
+# stage: 0 pending, 1 dispatched, 2 preview uploaded (final rendering), -1 failed, >1000 done
+
+def timing_path(filename):
+    # kgen's word-timing JSON (lines / words / layout slots), stored next to the video
+    return os.path.splitext(filename)[0] + ".timing.json"
+
+def overlay_ass(song_id, path):
+    # lyrics to draw over a song that doesn't have them burned in: rendered from
+    # its word-timing sidecar, else an ASS next to the video. None: burned / no lyrics
+    timing = timing_path(path)
+    if os.path.exists(timing):
+        layout, note, burned = read_timing(timing)
+        if burned:
+            return None
+        ass = os.path.join(OVERLAY_DIR, f"{song_id}.ass")
+        if not os.path.exists(ass) or os.path.getmtime(ass) < os.path.getmtime(timing):
+            os.makedirs(OVERLAY_DIR, exist_ok=True)
+            write_ass(layout, ass, font=FONT, note=note) # the font kgen burns with
+        return ass
+    ass = os.path.splitext(path)[0] + ".ass"
+    return ass if os.path.exists(ass) else None
 
 class TrackManager():
     class VideoProducer(VideoStreamTrack):
@@ -51,6 +85,7 @@ class TrackManager():
             # print(self.parent._switch_at, self.parent._video_sync, self.parent._audio_sync)
             try:
                 frame = await self.parent._video.recv()
+                self.parent._tick(frame)
             except MediaStreamError:
                 if self.parent.queue:
                     # pass
@@ -123,6 +158,8 @@ class TrackManager():
         self._alt_media = None
         self.forcing = False
         self.channel = None
+        self._timing = None # /timing/<id> of the playing song, if it has a word-timing sidecar
+        self._pos_at = 0
 
         if self.queue:
             asyncio.ensure_future(self._open_next())
@@ -149,7 +186,16 @@ class TrackManager():
             gc.collect()
             path =  path_wrapper(await get_song_by_id(self.queue[0][0]))
             # await (await aiofiles.open(path, 'rb')).read()
-            media = MediaPlayer(path)
+            overlay = None
+            if OVERLAY == 'server':
+                try:
+                    overlay = overlay_ass(self.queue[0][0], path)
+                except Exception as e:
+                    print("[!]overlay:", e)
+            media = MediaPlayer(path, overlay=overlay)
+            # the TV page draws the lyrics only if the stream doesn't carry them
+            self._timing = (f"/timing/{self.queue[0][0]}"
+                            if os.path.exists(timing_path(path)) and not media.overlay else None)
             self._media = media
             self._video = media.video
             self._audio = media.audio
@@ -168,6 +214,7 @@ class TrackManager():
                     "type": "info",
                     "data": self.queue
                 }))
+                self.send_timing()
 
         # except:
             # self._video = None
@@ -175,6 +222,24 @@ class TrackManager():
             # self._alt_audio = None
         # print("[!]open next: ", self.queue, self._video, self._audio, self._alt_audio)
 
+    def send_timing(self):
+        # tell the TV page where the playing song's word timing is (null: none)
+        self.channel.send(json.dumps({
+            "type": "timing",
+            "data": self._timing
+        }))
+
+    def _tick(self, frame):
+        # song position (s) of the frame being sent, ~once a second, so the TV
+        # page can run its word-timing overlay on the song's clock
+        now = time.time()
+        if self.channel and self._timing and frame.time is not None and now - self._pos_at >= 1.0:
+            self._pos_at = now
+            try:
+                self.channel.send(json.dumps({"type": "pos", "data": frame.time}))
+            except Exception:
+                pass
+
     async def _preload(self):
         if len(self.queue) > 2:
             path =  path_wrapper(await get_song_by_id(self.queue[1][0]))
@@ -365,6 +430,7 @@ async def offer(request):
     @pc.on("datachannel")
     def on_datachannel(channel):
         webcam.channel = channel
+        webcam.send_timing()
 
 
     answer = await pc.createAnswer()
@@ -401,62 +467,218 @@ async def add_yt_source(request):
     global workset
     params = await request.json()
     # add_task(params['url'], params['title'], params['singer'], params.get('caps', None))
-    workset.append(
-        [ 0, str(uuid.uuid4()),
-            params['url'], params['title'], params['singer'], params.get('caps', None)]
-    )
+    url, caps = params['url'], params.get('caps', None)
+    model, guide_vol = params.get('model', None), params.get('guide_vol', None)
+    # rendered before with the same parameters: queue that song instead of rendering again
+    done = renders.find(url, caps, model, guide_vol)
+    if done and await get_song_by_id(done["song"]) is not None:
+        print("reusing render of", done["video"], "as song", done["song"])
+        await webcam.put([done["song"], done["title"], done["singer"], done["file"]])
+        asyncio.ensure_future(broadcast_queue())
+        return web.Response(content_type="application/json", text=json.dumps("success"))
+    # being rendered right now: the song is queued when that job registers it
+    running = jobs.in_flight(url, caps, model, guide_vol)
+    if running:
+        print("coalesced request for", url, "onto job", running[1])
+        return web.Response(content_type="application/json", text=json.dumps("success"))
+    jobs.add(str(uuid.uuid4()), url, params['title'], params['singer'], caps, model, guide_vol)
     return web.Response(content_type="application/json", text=json.dumps("success"))
 
 async def put_link(request):
     params = await request.json()
     return web.Response(content_type="application/json", text=json.dumps( await video_info(params['url'])))
 
+def worker_caps(request):
+    # what a polling worker can take: ?worker=&slots=&cores=&mem=&models=a,b
+    # (older workers send none of it: one slot, keyed by address);
+    # ValueError on malformed numbers
+    q = request.query
+    worker = q.get('worker') or request.remote
+    caps = {"slots": int(q.get('slots', 1)), "cores": int(q.get('cores', 0)),
+            "mem": float(q.get('mem', 0)), "models": [m for m in q.get('models', '').split(',') if m]}
+    return worker, caps
+
+def bad_request(error):
+    return web.Response(content_type="application/json", text=json.dumps({"error": error}), status=400)
+
 async def poll_task(request: web.Request):
-    global workset
-    for _ in range(15):
-        for work in workset:
-            if work[0] == 0:
-                work[0] = 1
-                return web.Response(content_type="application/json", text=json.dumps(work))
-            elif work[0] == 1: # already dispatched, should be error
-                work[0] = -1
-        await asyncio.sleep(2)
-        # check if connection is still alive
-        if request.transport is None or request.transport.is_closing():
-            return web.Response(content_type="application/json", text=json.dumps({}), status=204)
+    try:
+        worker, caps = worker_caps(request)
+    except ValueError as e:
+        return bad_request(f"bad worker capacity: {e}")
+    # long poll: woken as soon as a job is added or requeued
+    work = await jobs.take(worker, caps, timeout=30,
+                           alive=lambda: request.transport is not None and not request.transport.is_closing())
+    if work:
+        print("dispatched", work[1], "to", worker, caps)
+        asyncio.ensure_future(broadcast_queue())
+        return web.Response(content_type="application/json", text=json.dumps(work))
     # status code not ready
     return web.Response(content_type="application/json", text=json.dumps({}), status=204) # timeout
 
+async def heartbeat(request):
+    # {worker, uuid, state: running | failed}: renew the lease / hand the job back
+    try:
+        params = await request.json()
+    except ValueError:
+        return bad_request("body is not JSON")
+    if not (isinstance(params, dict) and isinstance(params.get('worker'), str)
+            and isinstance(params.get('uuid'), str)
+            and params.get('state', 'running') in ('running', 'failed')):
+        return bad_request("expected {worker, uuid, state: running | failed}")
+    if params.get('state') == 'failed':
+        if jobs.heartbeat(params['worker'], params['uuid']):
+            jobs.release(params['uuid'], failed=True)
+            asyncio.ensure_future(broadcast_queue())
+        return web.Response(content_type="application/json", text=json.dumps({}), status=200)
+    if not jobs.heartbeat(params['worker'], params['uuid']):
+        return web.Response(content_type="application/json", text=json.dumps({"lease": False}), status=409)
+    return web.Response(content_type="application/json", text=json.dumps({"lease": True}), status=200)
+
+async def register_upload(task, kind, filename, form):
+    # a complete render is in place at `filename`: store its word timing, update the
+    # task, and register / queue the song (a final replaces its preview in place)
+    task_uuid = task[1]
+    if form.get("timing"):
+        async with aiofiles.open(timing_path(filename) + ".part", 'w') as f:
+            await f.write(form["timing"])
+        os.replace(timing_path(filename) + ".part", timing_path(filename))
+    meta = jobs.meta[task_uuid]
+    song = meta.get("preview")
+    if kind == "preview":
+        task[0] = 2
+    else:
+        task[0] = max(task[0], 0) + 10000
+    if meta.get("preview"): # already registered by its preview; the file was just swapped
+        if kind != "preview":
+            meta.pop("preview")
+    else:
+        ret = song = await add_song(task[3]+ "(YTB)", task[4], filename)
+        if kind == "preview":
+            meta["preview"] = ret # SongID registered for the preview render
+        await webcam.put([ret, task[3] + "(YTB)", task[4], filename])
+    if kind == "preview":
+        jobs.save()
+    else:
+        jobs.release(task_uuid)
+        # the worker reports the model / guide volume it used (older workers don't)
+        renders.add(task[2], task[5], form.get("model"), form.get("guide_vol"),
+                    song, task[3] + "(YTB)", task[4], filename)
+    asyncio.ensure_future(broadcast_queue())
+    return web.Response(content_type="application/json", text=json.dumps({}), status=200)
+
 async def submit_task(request):
     global workset, webcam
     # recive the file content
     reader = await request.multipart()
 
+    # form fields, then the file: uuid, kind (preview | final; older workers send
+    # no kind), and for a streamed upload (fragmented MP4 sent while the worker
+    # is still encoding) offset = byte position of this chunk, final = 1 on the
+    # last one. Without offset the body is the whole file.
+    form = {}
     field = await reader.next()
-    task_uuid = await field.read(decode=True)
-    task_uuid = task_uuid.decode('utf-8')
-    print(task_uuid)
+    while field is not None and field.name != "file_content":
+        form[field.name] = (await field.read(decode=True)).decode('utf-8')
+        field = await reader.next()
+    task_uuid = form.get("uuid")
+    kind = form.get("kind", "final")
+    try:
+        offset = int(form.get("offset", 0))
+    except ValueError:
+        return bad_request("offset must be a byte count")
+    if offset < 0:
+        return bad_request("offset must be a byte count")
+    last = form.get("final", "1") == "1"
+    print(task_uuid, kind, offset, "final" if last else "chunk")
     for task in workset:
         if task[1] != task_uuid:
             continue
-        task[0] += 10000
+        if task[0] > 1000: # a worker whose lease ran out finished after the re-run did
+            print("already done", task_uuid)
+            return web.Response(content_type="application/json", text=json.dumps({}), status=409)
+        # one file per job: renders of one song with other captions / model / guide
+        # volume (kept apart by the render registry) never overwrite each other
+        filename = f"{OUTPUT_DIR}/{task[3]}(YTB)-{task[4]}-{task_uuid[:8]}.mp4"
+        # each worker writes its own .part (and ingest state), so a worker whose
+        # lease ran out can't interleave with the one that took the job over
+        worker = form.get("worker")
+        part = f"{filename}.{re.sub(r'[^0-9A-Za-z_.-]', '_', worker or 'worker')}.part"
+        if worker is None:
+            jobs.touch(task_uuid) # older workers send no id: the lease holder can't be checked
+        elif not jobs.heartbeat(worker, task_uuid):
+            print("upload for", task_uuid, "from", worker, "which no longer holds its lease")
+            ingest.discard(part)
+            return web.Response(content_type="application/json", text=json.dumps({"lease": False}), status=409)
+
+        if form.get("spool"):
+            # co-located worker: the finished file is already on this filesystem
+            src = os.path.join(SPOOL_DIR, os.path.basename(form["spool"]))
+            if not os.path.isfile(src):
+                print("spool file missing", src)
+                return web.Response(content_type="application/json", text=json.dumps({}), status=404)
+            t0 = time.time()
+            try:
+                os.replace(src, filename)
+            except OSError as e: # spool on another filesystem after all: copy once, off the loop
+                if e.errno != errno.EXDEV:
+                    raise
+                await asyncio.get_running_loop().run_in_executor(ingest.POOL, shutil.copyfile, src, part)
+                os.replace(part, filename)
+                os.remove(src)
+            print(f"handoff {task_uuid} {kind}: {os.path.getsize(filename) / 2**20:.1f} MB "
+                  f"in {(time.time() - t0) * 1000:.1f}ms")
+            return await register_upload(task, kind, filename, form)
+
+        # write aside and rename over: a queued (or playing) preview is replaced
+        # in place by the final render, never read half-written
+        if offset and (not os.path.exists(part) or os.path.getsize(part) != offset):
+            have = os.path.getsize(part) if os.path.exists(part) else 0
+            print("chunk out of order", offset, have)
+            return web.Response(content_type="application/json", text=json.dumps({"size": have}), status=409)
+        # written and hashed on a thread pool with bounded buffering (see ingest.py):
+        # the live stream's frame pacing shares this event loop
+        await ingest.ingest(field, part, offset)
+        if not last:
+            return web.Response(content_type="application/json",
+                                text=json.dumps({"size": os.path.getsize(part)}), status=200)
+        sha, size, secs = ingest.finish(part)
+        print(f"upload {task_uuid} {kind}: {size / 2**20:.1f} MB in {secs:.1f}s "
+              f"({size / 2**20 / max(secs, 1e-3):.1f} MB/s), sha256 {sha[:12] if sha else '?'}")
+        if form.get("sha256") and sha and form["sha256"] != sha:
+            print("sha256 mismatch, worker sent", form["sha256"][:12])
+            ingest.discard(part)
+            return web.Response(content_type="application/json", text=json.dumps({"sha256": sha}), status=422)
         print(task)
-        filename = f"{OUTPUT_DIR}/{task[3]}(YTB)-{task[4]}.mp4"
-        field = await reader.next()
-
-        with open(filename, 'wb') as f:
-            while True:
-                chunk = await field.read_chunk()
-                if not chunk:
-                    break
-                f.write(chunk)
-            ret = await add_song(task[3]+ "(YTB)", task[4], filename)
-            await webcam.put([ret, task[3] + "(YTB)", task[4], filename])
-            asyncio.ensure_future(broadcast_queue())
-            return web.Response(content_type="application/json", text=json.dumps({}), status=200)
+        os.replace(part, filename)
+        return await register_upload(task, kind, filename, form)
     print("not found")
     return web.Response(content_type="application/json", text=json.dumps({}), status=404)
 
+async def spool(request):
+    # co-located workers: GET → the nonce to write into a probe file in the spool;
+    # POST {name} → whether that probe is visible here with the right nonce
+    if request.method == 'GET':
+        return web.Response(content_type="application/json", text=json.dumps({"nonce": SPOOL_NONCE}))
+    params = await request.json()
+    try:
+        with open(os.path.join(SPOOL_DIR, os.path.basename(params['name']))) as f:
+            ok = f.read().strip() == SPOOL_NONCE
+    except (OSError, KeyError):
+        ok = False
+    return web.Response(content_type="application/json", text=json.dumps({"ok": ok}))
+
+async def get_timing(request):
+    # word-timing sidecar of a song (see timing_path), for the TV page's overlay
+    try:
+        path = await get_song_by_id(int(request.match_info['song_id']))
+    except ValueError:
+        path = None
+    if not path or not os.path.exists(timing_path(path_wrapper(path))):
+        return web.Response(content_type="application/json", text="null", status=404)
+    async with aiofiles.open(timing_path(path_wrapper(path)), 'r', encoding='utf-8') as f:
+        return web.Response(content_type="application/json", text=await f.read())
+
 pcs = set()
 websockets = set()
 
@@ -489,6 +711,10 @@ async def broadcast_queue():
         except:
             pass
 
+async def start_jobs(app):
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    asyncio.ensure_future(jobs.reap())
+
 async def on_shutdown(app):
     # close peer connections
     coros = [pc.close() for pc in pcs]
@@ -511,7 +737,10 @@ if __name__ == "__main__":
     )
     parser.add_argument("--verbose", "-v", action="count")
     parser.add_argument("--youtube", "-y", action="store_true", default=False, help="Enable youtube agent")
+    parser.add_argument("--overlay", choices=["server", "client"], default=OVERLAY,
+                        help="draw lyrics that aren't burned in on the server (libass, every viewer) or on the TV page")
     args = parser.parse_args()
+    OVERLAY = args.overlay
 
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
@@ -536,6 +765,7 @@ if __name__ == "__main__":
     app.router.add_get('/singers', ret_singers)
     app.router.add_get('/console.js', consolejs)
     app.router.add_get('/ws', websocket_handler)
+    app.router.add_get('/timing/{song_id}', get_timing)
     app.router.add_get('/i18n-{lang}.json', i18n)
     if args.youtube:
         # yt_init(f"http://{args.host}:{args.port}/op" if ssl_context is None else f"https://{args.host}:{args.port}/op")
@@ -544,5 +774,9 @@ if __name__ == "__main__":
         app.router.add_get('/yt', yt_page)
         app.router.add_post('/yt_link', put_link)
         app.router.add_post('/submit_task', submit_task)
+        app.router.add_post('/heartbeat', heartbeat)
+        app.router.add_get('/spool', spool)
+        app.router.add_post('/spool', spool)
         app.router.add_get('/poll_task', poll_task)
+        app.on_startup.append(start_jobs)
     web.run_app(app, host=args.host, port=args.port, ssl_context=ssl_context)
\ No newline at end of file